@@ -0,0 +1,172 @@
+#!/usr/bin/python
+'''
+End to end benchmark of DashApi against the offline mock dashboard.
+
+Runs gather_keys() from library/meraki_network_facts.py with the given
+module options and reports dashboard requests, wall time, peak RSS and
+requests/sec as JSON. --max-requests and --max-seconds turn the run into a
+regression guard: the exit code is 1 when either bound is exceeded.
+
+    python bench/bench_dashapi.py --networks 20 --devices 30 --scope organization \\
+        --option max_concurrency=8 --option rate_limit=0 --max-requests 700
+
+Requires ansible and requests to be importable, no network access.
+'''
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+from mock_dashboard import Dataset, MockDashboard
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_source(name, path):
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_modules():
+    #module_utils/meraki.py is imported by the module as ansible.module_utils.meraki
+    meraki = load_source('ansible.module_utils.meraki', os.path.join(ROOT, 'module_utils', 'meraki.py'))
+    try:
+        load_source('ansible.module_utils.meraki_async', os.path.join(ROOT, 'module_utils', 'meraki_async.py'))
+    except (ImportError, SyntaxError):
+        sys.modules.pop('ansible.module_utils.meraki_async', None)
+    facts = load_source('meraki_network_facts', os.path.join(ROOT, 'library', 'meraki_network_facts.py'))
+    return meraki, facts
+
+
+class BenchFailure(Exception):
+    pass
+
+
+class BenchModule:
+    #minimal AnsibleModule stand-in carrying already validated params
+    def __init__(self, params):
+        self.params = params
+
+    def fail_json(self, **kwargs):
+        raise BenchFailure(kwargs.get('msg'))
+
+    def exit_json(self, **kwargs):
+        return kwargs
+
+
+def module_params(meraki, options):
+    params = dict((k, v.get('default')) for k, v in meraki.meraki_argument_spec().items())
+    params.update(api_key='0' * 40, organization='552400', networkid=None,
+        networkname=None, serial=None, serials=None, networknames=None, scope='network',
+        org_filter=None, org_concurrency=4)
+    params.update(options)
+    return params
+
+
+def parse_option(text):
+    key, _, value = text.partition('=')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key, value
+
+
+def run(args):
+    meraki, facts = load_modules()
+    dataset = Dataset(args.orgs, args.networks, args.devices, args.clients)
+    server = MockDashboard(dataset, args.port, latency=args.latency, throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate, shard=args.shard).start()
+    options = dict(parse_option(o) for o in args.option)
+    if args.scope in ('organization', 'all'):
+        options['scope'] = args.scope
+        if args.scope == 'all':
+            options['organization'] = None
+    elif args.scope == 'serial':
+        options['serial'] = dataset.inventory['552400'][0]['serial']
+    elif args.scope == 'networkname':
+        options['networkname'] = dataset.networks['552400'][0]['name']
+    elif args.scope == 'serials':
+        options['serials'] = [d['serial'] for d in dataset.inventory['552400'][-args.batch:]]
+    elif args.scope == 'networknames':
+        options['networknames'] = [n['name'] for n in dataset.networks['552400'][-args.batch:]]
+    else:
+        options['networkid'] = dataset.networks['552400'][0]['id']
+    module = BenchModule(module_params(meraki, options))
+
+    start = time.time()
+    dash = meraki.dash_api(module)
+    dash.baseurl = server.baseurl
+    failure = None
+    try:
+        facts.gather_keys(dash, module)
+        dash.finish()
+    except BenchFailure as e:
+        failure = str(e)[:500]
+    elapsed = time.time() - start
+    server.shutdown()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    report = {
+        'scope': args.scope,
+        'options': options,
+        'requests': server.stats['requests'],
+        'server': server.stats,
+        'client': dash.result['ansible_facts'].get('api-requests'),
+        'organizations': dash.result['ansible_facts'].get('organization_summary'),
+        'perf': dash.result['ansible_facts'].get('perf'),
+        'wall_seconds': round(elapsed, 3),
+        'requests_per_second': round(server.stats['requests'] / elapsed, 1) if elapsed else None,
+        'peak_rss_kb': rss,
+        'failure': failure,
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--orgs', type=int, default=1)
+    parser.add_argument('--networks', type=int, default=10)
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=0,
+        help='mock dashboard port, fixed so cache and delta state carry over between runs')
+    parser.add_argument('--shard', action='store_true',
+        help='start at a redirecting dashboard name, see mock_dashboard.py')
+    parser.add_argument('--scope', default='networkid',
+        choices=['networkid', 'networkname', 'serial', 'serials', 'networknames', 'organization', 'all'])
+    parser.add_argument('--batch', type=int, default=10,
+        help='number of serials / network names with --scope serials / networknames')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE',
+        help='module option, VALUE is parsed as JSON when possible')
+    parser.add_argument('--max-requests', type=int, help='fail when more requests are issued')
+    parser.add_argument('--max-seconds', type=float, help='fail when the run takes longer')
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if report['failure']:
+        sys.exit(1)
+    if args.max_requests is not None and report['requests'] > args.max_requests:
+        sys.exit(1)
+    if args.max_seconds is not None and report['wall_seconds'] > args.max_seconds:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
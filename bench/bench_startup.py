@@ -0,0 +1,170 @@
+#!/usr/bin/python
+'''
+Per-task startup benchmark of meraki_network_facts against the mock dashboard.
+
+Ansible runs every task in a fresh interpreter that imports the module and
+its module_utils from the AnsiballZ payload. This starts --runs such
+interpreters one after another, each importing from a zip of the module and
+module_utils/, and times in each the imports, building the DashApi, the
+first dashboard request and the rest of the task (gather_keys() and
+finish()). Reports the median/min/max of every phase, the number of modules
+the imports load and the size of the zip as JSON. --max-seconds fails the
+run (exit code 1) when the median time to first request exceeds it.
+
+    python bench/bench_startup.py --runs 20 --option transport=async
+
+Requires ansible and requests to be importable, no network access.
+'''
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from mock_dashboard import Dataset, MockDashboard
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ['spawn', 'imports', 'init', 'first_request', 'to_first_request', 'task', 'total']
+
+#runs in the task interpreter: argv is the payload zip, spawn time, base URL
+#and module params as JSON
+CHILD = '''
+import os, sys, time
+started = time.time()
+payload, spawned, baseurl, params = sys.argv[1], float(sys.argv[2]), sys.argv[3], sys.argv[4]
+loaded = len(sys.modules)
+
+#as from an AnsiballZ payload: sources are compiled from the zip on every
+#run and module_utils/ resolves as ansible.module_utils
+import ansible.module_utils
+ansible.module_utils.__path__.insert(0, os.path.join(payload, 'module_utils'))
+sys.path.insert(0, payload)
+import meraki_network_facts as facts
+from ansible.module_utils import meraki
+imported = time.time()
+modules = len(sys.modules) - loaded
+
+import json
+class Module(object):
+    def __init__(self, params):
+        self.params = params
+    def fail_json(self, **kwargs):
+        raise SystemExit(kwargs.get('msg'))
+module = Module(json.loads(params))
+dash = meraki.dash_api(module)
+dash.baseurl = baseurl
+built = time.time()
+
+dash.fetch('network', '/networks/' + module.params['networkid'])
+first = time.time()
+facts.gather_keys(dash, module)
+dash.finish(perf=False)
+done = time.time()
+
+print(json.dumps({
+    'spawn': started - spawned,
+    'imports': imported - started,
+    'init': built - imported,
+    'first_request': first - built,
+    'to_first_request': first - spawned,
+    'task': done - first,
+    'total': done - spawned,
+    'modules': modules,
+    'requests': dash.result['ansible_facts']['api-requests']['issued'],
+}))
+'''
+
+
+def build_payload(path):
+    #zip the module and module_utils/ like AnsiballZ does for every task
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.write(os.path.join(ROOT, 'library', 'meraki_network_facts.py'), 'meraki_network_facts.py')
+        for name in sorted(os.listdir(os.path.join(ROOT, 'module_utils'))):
+            if name.endswith('.py'):
+                z.write(os.path.join(ROOT, 'module_utils', name), 'module_utils/' + name)
+        files = len(z.namelist())
+        raw = sum(i.file_size for i in z.infolist())
+    return {'files': files, 'bytes': raw, 'zipped_bytes': os.path.getsize(path)}
+
+
+def summarize(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    median = values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+    return {'median': round(median * 1000, 1), 'min': round(values[0] * 1000, 1),
+        'max': round(values[-1] * 1000, 1)}
+
+
+def run(args):
+    from bench_dashapi import load_modules, module_params, parse_option
+    meraki, _ = load_modules()
+    dataset = Dataset(1, args.networks, args.devices, args.clients)
+    server = MockDashboard(dataset, args.port, latency=args.latency).start()
+    options = dict(parse_option(o) for o in args.option)
+    options['networkid'] = dataset.networks['552400'][0]['id']
+    params = module_params(meraki, options)
+
+    directory = tempfile.mkdtemp()
+    payload = os.path.join(directory, 'payload.zip')
+    size = build_payload(payload)
+    samples = []
+    failure = None
+    try:
+        for _ in range(args.runs):
+            command = [sys.executable, '-c', CHILD, payload, repr(time.time()), server.baseurl,
+                json.dumps(params)]
+            child = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = child.communicate()
+            if child.returncode:
+                failure = (err or out).decode('utf-8', 'replace')[-500:]
+                break
+            samples.append(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+    report = {
+        'options': options,
+        'runs': len(samples),
+        'payload': size,
+        'failure': failure,
+    }
+    if samples:
+        report['milliseconds'] = dict((phase, summarize([s[phase] for s in samples]))
+            for phase in PHASES)
+        report['modules_imported'] = samples[-1]['modules']
+        report['requests_per_task'] = samples[-1]['requests']
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='task interpreters to start')
+    parser.add_argument('--networks', type=int, default=5)
+    parser.add_argument('--devices', type=int, default=5)
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=0,
+        help='mock dashboard port, fixed so cache and delta state carry over between runs')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE',
+        help='module option, VALUE is parsed as JSON when possible')
+    parser.add_argument('--max-seconds', type=float,
+        help='fail when the median time to first request is longer')
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if report['failure'] or not report['runs']:
+        sys.exit(1)
+    if args.max_seconds is not None \
+            and report['milliseconds']['to_first_request']['median'] > args.max_seconds * 1000:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
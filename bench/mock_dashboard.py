@@ -0,0 +1,231 @@
+#!/usr/bin/python
+'''
+Offline stand-in for the Meraki dashboard API (v0), used by the benchmarks.
+
+Serves synthetic organizations, networks, devices and clients at a
+configurable scale and can inject latency, 429 throttling and 5xx errors.
+List endpoints honour perPage/startingAfter with Link rel=next headers and
+every answer carries an ETag that is matched against If-None-Match.
+With --shard, requests sent to the "localhost" name are redirected to the
+127.0.0.1 "shard", like dashboard.meraki.com redirects to nXXX.meraki.com.
+
+    python bench/mock_dashboard.py --networks 50 --devices 20 --port 8080
+'''
+import argparse
+import hashlib
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qsl, urlencode
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qsl
+    from urllib import urlencode
+
+MODELS = ['MX100', 'MS220-8P', 'MR33', 'MR42', 'MV21', 'MG21', 'Z3']
+
+
+class Dataset:
+    #synthetic organizations -> networks -> devices -> clients
+    def __init__(self, orgs=1, networks=10, devices=10, clients=20, seed=0):
+        rnd = random.Random(seed)
+        self.organizations = []
+        self.networks = {}
+        self.inventory = {}
+        self.devices = {}
+        self.clients = {}
+        for o in range(orgs):
+            orgid = str(552400 + o)
+            self.organizations.append({'id': int(orgid), 'name': 'org%d' % o})
+            self.networks[orgid] = []
+            self.inventory[orgid] = []
+            for n in range(networks):
+                netid = 'N_%d%04d' % (o, n)
+                network = {'id': netid, 'organizationId': orgid, 'name': 'net%d' % n,
+                    'timeZone': 'America/Los_Angeles', 'tags': '', 'type': 'combined'}
+                self.networks[orgid].append(network)
+                for d in range(devices):
+                    serial = 'Q%d%02d-%04d-%04d' % (o, n % 100, n, d)
+                    device = {'serial': serial, 'networkId': netid,
+                        'model': MODELS[d % len(MODELS)],
+                        'mac': '00:18:0a:%02x:%02x:%02x' % (o, n % 256, d % 256),
+                        'name': None, 'lanIp': '10.%d.%d.%d' % (o, n % 256, d % 256)}
+                    self.inventory[orgid].append(device)
+                    self.devices[serial] = device
+                    self.clients[serial] = [{'id': 'k%d' % c, 'description': None,
+                        'mdnsName': None, 'dhcpHostname': None,
+                        'mac': '24:e9:%02x:%02x:%02x:%02x' % (n % 256, d % 256, c // 256, c % 256),
+                        'ip': '192.168.%d.%d' % (d % 256, c % 256),
+                        'vlan': str(c % 4),
+                        'switchport': None,
+                        'usage': {'sent': rnd.random() * 1e5, 'recv': rnd.random() * 1e6}}
+                        for c in range(clients)]
+
+    def route(self, parts):
+        #payload for a /api/v0/... path split into its segments, None for 404
+        if parts == ['organizations']:
+            return self.organizations
+        if parts[0] == 'organizations' and len(parts) == 2:
+            return [o for o in self.organizations if str(o['id']) == parts[1]][0]
+        if parts[0] == 'organizations' and parts[2:] == ['networks']:
+            return self.networks.get(parts[1])
+        if parts[0] == 'organizations' and parts[2:] == ['inventory']:
+            return self.inventory.get(parts[1])
+        if parts[0] == 'networks':
+            devices = [d for org in self.inventory.values() for d in org if d['networkId'] == parts[1]]
+            if len(parts) == 2:
+                for org in self.networks.values():
+                    for network in org:
+                        if network['id'] == parts[1]:
+                            return network
+                return None
+            if parts[2:] == ['devices']:
+                return devices
+            if len(parts) >= 4 and parts[2] == 'devices':
+                device = self.devices.get(parts[3])
+                if device is not None and device['networkId'] != parts[1]:
+                    return None
+                if len(parts) == 4:
+                    return device
+                if parts[4] == 'uplink' and device is not None:
+                    return [{'interface': 'WAN 1', 'status': 'Active', 'ip': device['lanIp'],
+                        'gateway': '10.0.0.1', 'publicIp': '1.2.3.4', 'dns': '8.8.8.8',
+                        'usingStaticIp': True}]
+            if parts[2:] in (['vlans'], ['staticRoutes'], ['ssids'], ['siteToSiteVpn']):
+                return [{'id': 1, 'name': parts[2], 'networkId': parts[1]}]
+        if parts[0] == 'devices' and len(parts) == 3 and parts[1] in self.devices:
+            if parts[2] == 'clients':
+                return self.clients[parts[1]]
+            if parts[2] == 'switchPorts':
+                return [{'number': p, 'enabled': True, 'type': 'access', 'vlan': 1} for p in range(1, 9)]
+        return None
+
+
+class MockDashboard(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, dataset, port=0, latency=0.0, throttle_rate=0.0,
+            error_rate=0.0, shard=False, seed=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.dataset = dataset
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.shard = shard
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'throttled': 0, 'errors': 0, 'not_modified': 0,
+            'redirects': 0, 'bytes': 0}
+
+    @property
+    def baseurl(self):
+        #with shard redirects the client starts at the redirecting name
+        host = 'localhost' if self.shard else '127.0.0.1'
+        return 'http://%s:%d/api/v0' % (host, self.server_address[1])
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def handle_error(self, request, client_address):
+        #a client that timed out has closed its connection before the answer
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #headers and body go out in two writes, without TCP_NODELAY every
+    #keep-alive answer would wait on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count('bytes', len(body))
+
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+        if server.latency:
+            time.sleep(server.latency * (0.5 + server.random.random()))
+        with server.lock:
+            roll = server.random.random()
+        if roll < server.throttle_rate:
+            server.count('throttled')
+            return self.reply(429, b'{"errors": ["Too Many Requests"]}', {'Retry-After': '1'})
+        if roll < server.throttle_rate + server.error_rate:
+            server.count('errors')
+            return self.reply(503, b'{"errors": ["Service Unavailable"]}')
+        if server.shard and not self.headers.get('Host', '').startswith('127.0.0.1'):
+            server.count('redirects')
+            return self.reply(302, b'', {'Location': 'http://127.0.0.1:%d%s'
+                % (server.server_address[1], self.path)})
+        if not self.headers.get('x-cisco-meraki-api-key'):
+            return self.reply(401, b'{"errors": ["Invalid API key"]}')
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')[2:]
+        query = dict(parse_qsl(url.query))
+        payload = server.dataset.route(parts) if parts else None
+        if payload is None:
+            return self.reply(404, b'{"errors": ["Not Found"]}')
+        headers = {'Content-Type': 'application/json'}
+        if isinstance(payload, list) and 'perPage' in query:
+            per_page = int(query['perPage'])
+            start = int(query.get('startingAfter', 0))
+            if start + per_page < len(payload):
+                query['startingAfter'] = str(start + per_page)
+                headers['Link'] = '<http://%s:%d%s?%s>; rel=next' % (self.server.server_address
+                    + (url.path, urlencode(query)))
+            payload = payload[start:start + per_page]
+        body = json.dumps(payload).encode('utf-8')
+        headers['ETag'] = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            server.count('not_modified')
+            return self.reply(304, b'', {'ETag': headers['ETag']})
+        self.reply(200, body, headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--orgs', type=int, default=1)
+    parser.add_argument('--networks', type=int, default=10)
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds added per request')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction answered with 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction answered with 503')
+    parser.add_argument('--shard', action='store_true', help='redirect localhost to the 127.0.0.1 shard')
+    args = parser.parse_args()
+    dataset = Dataset(args.orgs, args.networks, args.devices, args.clients)
+    server = MockDashboard(dataset, args.port, args.latency, args.throttle_rate, args.error_rate,
+        args.shard)
+    print('serving %s' % server.baseurl)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -17,13 +17,15 @@ options:
     organization:
             description:
               - 6 digit string that identifies a collection of networks.
-            required: true
+                Required unless scope is C(all).
+            required: false
     networkid:
             description:
               - 20 char string that identifies a container of devices,
                 configs, stats, and any client-device information.
                 Multiple devices may belong to one netork.
-                One of options [networkid, networkname, serial] is required
+                One of options [networkid, networkname, serial, serials,
+                networknames] is required
             required: false
     networkname:
             description:
@@ -31,15 +33,58 @@ options:
                 identifies a container of devices, configs, stats,
                 and any client-device information. Multiple devices
                 may belong to one netork.
-                One of options [networkid, networkname, serial] is required
+                One of options [networkid, networkname, serial, serials,
+                networknames] is required
             required: false
     serial:
             description:
                 - string that uniquely identifies a specific device.
                   only configs and stats of single device information
                   will be returned.
-                  One of options [networkid, networkname, serial] is required
+                  One of options [networkid, networkname, serial, serials,
+                  networknames] is required
+            required: false
+    serials:
+            description:
+                - list of serials resolved together with a single inventory
+                  lookup; facts of every device found and of its network are
+                  returned, keyed by networkId. Serials not found are listed
+                  under unresolved instead of failing the module.
+            required: false
+    networknames:
+            description:
+                - list of network names resolved together with a single
+                  network list lookup; facts of every network found are
+                  returned, keyed by networkId. Names not found are listed
+                  under unresolved instead of failing the module.
+            required: false
+    scope:
+            description:
+                - C(network) returns facts of the single network or device
+                  selected by networkid, networkname or serial.
+                  C(organization) collects the selected resources for every
+                  network of the organization in one module run, sharing
+                  connections, cache and concurrency; stdout is then keyed by
+                  networkId.
+                  C(all) does the same for every organization the API key can
+                  see (see org_filter), org_concurrency organizations at a
+                  time, each with its own rate_limit budget; stdout is then
+                  keyed by organization id and then networkId.
+            required: false
+            choices: ['network', 'organization', 'all']
+            default: network
+    org_filter:
+            description:
+                - With scope C(all), only sweep organizations whose name
+                  matches this regular expression (searched, use ^...$ for
+                  an exact name).
             required: false
+    org_concurrency:
+            description:
+                - With scope C(all), number of organizations swept at once.
+                  Each runs up to max_concurrency requests of its own.
+            required: false
+            default: 4
     timespan:
             description:
                 - The timespan for which clients will be fetched.
@@ -52,6 +97,9 @@ options:
             description:
                 - return values on specific network and /or device resoures. Such as
                   vlans, clients, s2svpn, ssids, etc
+                  Device resources are only requested from model families that
+                  support them, clients (MX, Z, MS, MR), uplinks (MX, Z, MG)
+                  and switchPorts (MS), and are keyed per serial.
             required: False
             default: (all values)
     headers:
@@ -60,6 +108,237 @@ options:
                 - Useful debugging. displays URL header sent to meraki dashboard.
             required: False
             default: False
+    pool_size:
+            type: int
+            description:
+                - Number of pooled HTTP connections kept open to the dashboard
+                  host for the duration of the module run.
+            required: False
+            default: 10
+    keepalive:
+            type: Boolean
+            description:
+                - Reuse connections between requests. When False, every request
+                  asks the server to close the connection.
+            required: False
+            default: True
+    compression:
+            type: Boolean
+            description:
+                - Request gzip compressed responses (Accept-Encoding gzip).
+            required: False
+            default: True
+    max_concurrency:
+            type: int
+            description:
+                - Maximum number of dashboard requests in flight at once.
+                  Per-device clients, uplinks and switchPorts requests are
+                  fanned out over a thread pool of this size and merged into
+                  stdout in a deterministic order. Keep at or below pool_size.
+            required: False
+            default: 1
+    rate_limit:
+            type: float
+            description:
+                - Client side limit of requests per second, shared by all
+                  requests of the run. A 429 answer pauses every request for
+                  the Retry-After period. 0 disables the limiter.
+            required: False
+            default: 5
+    max_retries:
+            type: int
+            description:
+                - Number of times a request answered with 429 or a 5xx status
+                  is retried, with jittered exponential backoff.
+            required: False
+            default: 3
+    cache:
+            type: str
+            description:
+                - Local response cache shared across tasks and hosts.
+                  C(use) serves unexpired responses from I(cache_dir) and stores
+                  new ones, C(refresh) always queries the dashboard and stores
+                  the responses, C(bypass) neither reads nor writes the cache.
+            choices: ['use', 'refresh', 'bypass']
+            required: False
+            default: bypass
+    cache_dir:
+            type: path
+            description:
+                - Directory holding the response cache. Entries are keyed by a
+                  hash of the API key, organization and API path, so a
+                  change of shard host keeps them.
+            required: False
+            default: ~/.ansible/meraki_cache
+    cache_ttl:
+            type: dict
+            description:
+                - Seconds a cached response is valid, per endpoint class. Merged
+                  over the defaults organizations=86400, inventory=3600,
+                  networks=3600, devices=3600, clients=300, uplink=300 and
+                  default=600 for any other class.
+            required: False
+            default: {}
+    cache_size:
+            type: int
+            description:
+                - Maximum size of the cache directory in MB, the oldest entries
+                  are evicted first, once at the end of a run that wrote to it.
+            required: False
+            default: 100
+    output:
+            type: str
+            description:
+                - C(facts) returns every payload in stdout. C(ndjson) and
+                  C(ndjson.gz) write each payload to a file in I(output_dir) as
+                  it arrives, one line per record, and stdout only holds the
+                  record count and bytes per key. Records are written page by
+                  page as they are decoded, unless I(delta), I(resume),
+                  I(snapshot), a client rollup or a I(cache) other than
+                  bypass need whole payloads. A failed run leaves the file
+                  readable up to its last record.
+            choices: ['facts', 'ndjson', 'ndjson.gz']
+            required: False
+            default: facts
+    output_dir:
+            type: path
+            description:
+                - Directory receiving the NDJSON output files.
+            required: False
+            default: ~/.ansible/meraki_output
+    per_page:
+            type: int
+            description:
+                - Page size requested from paginated collections (organizations,
+                  networks, inventory, devices, clients). Further pages are
+                  followed through the Link header; name and serial lookups
+                  stop reading pages once their match is found.
+            required: False
+    delta:
+            type: Boolean
+            description:
+                - Only return resources that changed since the previous run
+                  with the same API key. The ETag and content hash of every
+                  resource are kept in I(cache_dir) per organization and API
+                  path, whatever the shard host; requests are sent with
+                  If-None-Match and unchanged resources are left out of stdout.
+                  Collections requested with I(per_page) are always fetched
+                  in full and compared by hash, an ETag only covers one page.
+                  The changed keys are listed in changed_resources.
+            required: False
+            default: False
+    timeout:
+            type: float
+            description:
+                - Seconds to wait for the dashboard to answer a request.
+            required: False
+            default: 20
+    endpoint_timeouts:
+            type: dict
+            description:
+                - Per endpoint class timeouts in seconds overriding I(timeout),
+                  for example {clients: 60, uplink: 5}. Values must be
+                  numbers, strings like "60" are accepted.
+            required: False
+            default: {}
+    trace_file:
+            type: path
+            description:
+                - Append every request (endpoint class, URL, status, bytes,
+                  time to first byte and total time) as a JSON line to this file.
+            required: False
+    pin_shard:
+            type: Boolean
+            description:
+                - Remember the shard host the dashboard redirects an
+                  organization to (in I(cache_dir)/shards.json, per
+                  I(dashboard) host and organization) and send every later
+                  request straight to it. Like the response cache, pins are
+                  not used with I(cache) bypass. Redirects are always followed
+                  with the API key header kept.
+            required: False
+            default: True
+    serial_index:
+            type: Boolean
+            description:
+                - Remember the network and model of every serial read from the
+                  organization inventory (in I(cache_dir)/serials-<organization>.json).
+                  With I(serial) set, a known serial is then confirmed by one
+                  device lookup in its network instead of downloading the
+                  inventory. Serials not in the index, or whose device moved
+                  network, are looked up in the inventory as before. Like
+                  the response cache, the index is not used with I(cache)
+                  bypass.
+            required: False
+            default: True
+    transport:
+            description:
+                - C(sync) issues requests with requests, fanned out over
+                  max_concurrency threads. C(async) issues them on an asyncio
+                  event loop with aiohttp (Python 3.5+ and aiohttp required):
+                  up to max_concurrency requests in flight, however large,
+                  over at most pool_size connections, in one thread.
+                  Lookups of networks, inventory and devices are sent
+                  synchronously with either transport.
+            required: False
+            choices: ['sync', 'async']
+            default: sync
+    resume:
+            type: Boolean
+            description:
+                - Journal every collected payload to I(cache_dir) as it
+                  arrives. When a run fails (connection error, timeout), its
+                  journal is kept and returned as I(journal); rerunning the
+                  task for the same organization, scope, serials or networks,
+                  resources, timespan and per_page replays the journaled
+                  payloads and only requests what is missing; other options
+                  may change. The journal is removed when a run completes,
+                  journals not resumed within a day are removed too.
+            required: False
+            default: False
+    clients_output:
+            description:
+                - C(raw) returns the client list of every device as
+                  clients-SERIAL. C(rollup) returns a client_rollup per
+                  network instead, computed locally from the collected
+                  lists, and C(both) returns both. Only clients that were
+                  returned are rolled up, so in delta mode the rollup covers
+                  the client lists that changed.
+            required: False
+            choices: ['raw', 'rollup', 'both']
+            default: raw
+    top_talkers:
+            description:
+                - Number of clients listed under top_talkers in a
+                  client_rollup, by sent + recv usage.
+            required: False
+            default: 10
+    client_window:
+            description:
+                - Seconds. Client requests whose timespan is longer are split
+                  into consecutive t0/timespan windows of at most this size
+                  and merged by client MAC with usage summed. Requests issued
+                  concurrently fetch their windows one after another within
+                  their max_concurrency slot, a request issued alone fetches
+                  up to max_concurrency windows at once. The window halves when a
+                  window is slow (over a quarter of the clients timeout),
+                  larger than 2MB or times out, in which case it is split and
+                  retried, down to one hour; it grows back when windows are
+                  quick. The new size applies to the next windows of the
+                  same request. 0 sends the timespan in a single request.
+            required: False
+            default: 0
+    snapshot:
+            type: path
+            description:
+                - SQLite file the collected organizations, networks, devices,
+                  clients, VLANs, static routes and other payloads are written
+                  to, indexed on serial, MAC, IP and networkId. A network or
+                  device collected again replaces its earlier rows, so the
+                  file holds the latest state of everything collected so far.
+                  The rows are committed when the run succeeds. Query it with
+                  the meraki_snapshot lookup plugin.
+            required: False
 
 
 author:
@@ -81,6 +360,49 @@ EXAMPLES = '''
     api_key: 123456789A
     organization: 552400
     networkid: N_1234"
+
+
+- name: gather uplink facts about a batch of devices
+  meraki_network_facts:
+    api_key: 123456789A
+    organization: 552400
+    serials:
+          - Q2XX-XXXX-XXXX
+          - Q3XX-XXXX-XXXX
+    resources:
+          - uplinks
+
+
+- name: gather uplink and vlan facts about every network of an organization
+  meraki_network_facts:
+    api_key: 123456789A
+    organization: 552400
+    scope: organization
+    max_concurrency: 5
+    resources:
+          - uplinks
+          - vlans
+
+
+- name: gather uplink facts about every EMEA organization the API key can see
+  meraki_network_facts:
+    api_key: 123456789A
+    scope: all
+    org_filter: "^EMEA-"
+    org_concurrency: 8
+    resources:
+          - uplinks
+
+
+- name: keep a local snapshot of an organization, then ask it which device sees a MAC
+  meraki_network_facts:
+    api_key: 123456789A
+    organization: 552400
+    scope: organization
+    snapshot: ~/.ansible/meraki_snapshot.db
+- debug:
+    msg: "{{ lookup('meraki_snapshot', 'mac=24:e9:b3:26:1e:03',
+             snapshot='~/.ansible/meraki_snapshot.db', wantlist=True) }}"
 '''
 
 RETURN = '''
@@ -88,6 +410,60 @@ api-endpoints:
   description: nested dictionary of all URL iterated to retrieve state data
   returned: always
   type: dictionary
+perf:
+  description: per endpoint class call count, requests that raised (timeouts,
+               connection errors), 429/5xx answers retried, response bytes
+               read and p50/p95/p99/max
+               of the time to first byte (connect and TLS included) and of the
+               total request time, in seconds
+  returned: always
+  type: dictionary
+  sample: {"clients": {"calls": 212, "errors": 1, "retries": 3, "bytes": 4518230,
+           "ttfb": {"p50": 0.412, "p95": 1.93, "p99": 3.1, "max": 4.2},
+           "total": {"p50": 0.48, "p95": 2.31, "p99": 3.7, "max": 5.0}}}
+unresolved:
+  description: serials or networknames that were not found in the organization
+  returned: when serials or networknames is set
+  type: dictionary
+  sample: {"serials": ["Q2XX-XXXX-ZZZZ"]}
+organization_summary:
+  description: per organization id swept with scope all, its name, number of
+               networks collected, requests issued, seconds taken and why
+               it failed (null otherwise): the failing URL and the error
+               message when a request failed
+  returned: when scope is all
+  type: dictionary
+  sample: {"552400": {"name": "EMEA-Retail", "networks": 42, "requests": 131,
+           "seconds": 38.2, "failed": null}}
+changed_resources:
+  description: stdout keys whose content changed since the previous run
+  returned: when delta is True
+  type: list
+  sample: ["vlans", "routes"]
+snapshot:
+  description: path of the snapshot file and the rows written to each table
+  returned: when snapshot is set
+  type: dictionary
+  sample: {"path": "/home/user/.ansible/meraki_snapshot.db",
+           "rows": {"networks": 42, "devices": 510, "clients": 18230, "vlans": 160}}
+output:
+  description: manifest of the NDJSON file written when output is ndjson or
+               ndjson.gz, with its path, record count and size in bytes
+  returned: when output is not facts
+  type: dictionary
+  sample: {"path": "/home/user/.ansible/meraki_output/meraki-552400-20181018120000-4242.ndjson.gz",
+           "records": 52311, "bytes": 1843220}
+api-requests:
+  description: count of GET requests issued to the dashboard, of planned
+               URLs served from an earlier identical request (deduplicated)
+               , of 429/5xx answers that were retried, of responses
+               served from the local cache, of device requests not
+               planned because the model does not support the endpoint and
+               of payloads replayed from the journal of a failed run
+  returned: always
+  type: dictionary
+  sample: {"issued": 6, "deduplicated": 2, "retried": 0, "cached": 0, "pruned": 3,
+           "resumed": 0}
 stdout:
     clients:
       description: List the clients of a device, up to a maximum of a month ago.
@@ -109,6 +485,18 @@ stdout:
       description: List the static routes for this network
       returned: always
       type: list
+    client_rollup:
+      description: client usage of a network (in kilobytes) when clients_output
+                   is rollup or both. Clients seen by several devices (same
+                   MAC) are counted once with the largest usage reported;
+                   devices holds each device's own totals.
+      returned: when clients_output is rollup or both
+      type: dictionary
+      sample: {"clients": 2, "sent": 300.5, "recv": 1200.0,
+               "devices": {"Q2XX-XXXX-XXXX": {"clients": 2, "sent": 300.5, "recv": 1200.0}},
+               "vlans": {"10": {"clients": 2, "sent": 300.5, "recv": 1200.0}},
+               "top_talkers": [{"mac": "24:e9:b3:26:1e:03", "ip": "192.168.20.64",
+                 "vlan": 10, "description": null, "sent": 213.5, "recv": 1000.0}]}
 
 organizations:
     description: list of networks that belong to organization
@@ -203,19 +591,17 @@ organizations:
 
 '''
 
+import re
+
 from ansible.module_utils.meraki import meraki_argument_spec
-from ansible.module_utils.meraki import DashApi
+from ansible.module_utils.meraki import dash_api
 from ansible.module_utils.basic import AnsibleModule
 
 
 def iterate_devices(meraki, datalist):
-    for item in datalist:
-        key = item.keys()
-        keys = str(key[0])
-        device = item[keys][0]['serial']
-        model = item[keys][1]['model']
-        #get_device_elements(meraki, device, model)
-        meraki.resource_iterator(serial=device, model=model)
+    for device in datalist:
+        #get_device_elements(meraki, device.serial, device.model)
+        meraki.resource_iterator(serial=device.serial, model=device.model)
     return
 
 
@@ -234,17 +620,93 @@ def get_device_elements(meraki, serial, model):
     return
 
 
+def gather_networks(meraki, networks):
+    # plan every network record of NETWORKS, devices come from a single
+    # inventory fetch and results are keyed by networkId
+    for network in networks:
+        meraki.group = meraki.networkId = network.id
+        datalist = meraki.device_invid_query(network.id)
+        iterate_devices(meraki, datalist)
+        meraki.resource_iterator(networkid=network.id)
+    meraki.group = None
+    return
+
+def gather_organization(meraki, module):
+    # sweep every network of the organization in this one process
+    gather_networks(meraki, meraki.get_orgnetworks('query'))
+    meraki.build_url()
+    return meraki.result
+
+def gather_networknames(meraki, module):
+    # every named network resolved in one pass over the network list,
+    # names not found are reported under unresolved
+    names = module.params.get('networknames')
+    networks, missing = meraki.networks_by_name(names)
+    gather_networks(meraki, [networks[n] for n in names if n in networks])
+    meraki.result['ansible_facts']['unresolved'] = {'networknames': missing}
+    meraki.build_url()
+    return meraki.result
+
+def gather_serials(meraki, module):
+    # every serial resolved in one pass over the inventory, results are keyed
+    # by networkId. Serials not found, or not part of a network, are
+    # reported under unresolved
+    serials = module.params.get('serials')
+    devices, missing = meraki.devices_by_serial(serials)
+    networks = []
+    for serial in serials:
+        device = devices.get(serial)
+        if device is None:
+            continue
+        if device.networkId is None:
+            if serial not in missing:
+                missing.append(serial)
+            continue
+        meraki.group = meraki.networkId = device.networkId
+        meraki.resource_iterator(serial=device.serial, model=device.model)
+        if device.networkId not in networks:
+            networks.append(device.networkId)
+    for networkid in networks:
+        meraki.group = meraki.networkId = networkid
+        meraki.resource_iterator(networkid=networkid)
+    meraki.group = None
+    meraki.result['ansible_facts']['unresolved'] = {'serials': missing}
+    meraki.build_url()
+    return meraki.result
+
+
+def gather_all(meraki, module):
+    # sweep every organization visible to the API key whose name matches
+    # org_filter; one failing organization does not fail the others
+    where = None
+    if module.params.get('org_filter'):
+        try:
+            pattern = re.compile(module.params.get('org_filter'))
+        except re.error as e:
+            module.fail_json(msg='invalid org_filter: %s' % str(e))
+        where = lambda org: pattern.search(org.get('name') or '') is not None
+    return meraki.sweep_organizations(gather_organization, where,
+        module.params.get('org_concurrency'))
+
 def gather_keys(meraki, module):
+    if module.params.get('scope') == 'all':
+        return gather_all(meraki, module)
+    if module.params.get('scope') == 'organization':
+        return gather_organization(meraki, module)
+    if module.params.get('serials'):
+        return gather_serials(meraki, module)
+    if module.params.get('networknames'):
+        return gather_networknames(meraki, module)
     params = {}
     params['serial'] = module.params.get('serial')
     params['networkId'] = module.params.get('networkid')
     params['networkname'] = module.params.get('networkname')
     if params['serial']:
         #networks = meraki.net_serialid_query(params['serial'])
-        params['networkId'] = meraki.net_serialid_query(params['serial'])
-        model = meraki.device_idmodel_query(params['serial'])
+        device = meraki.device_serial_query(params['serial'])
+        params['networkId'] = device.networkId
         #get_device_elements(meraki, params['serial'], model)
-        meraki.resource_iterator(serial=params['serial'], model=model)
+        meraki.resource_iterator(serial=params['serial'], model=device.model)
     elif params['networkId']:
         datalist = meraki.device_netid_query(params['networkId'])
         iterate_devices(meraki, datalist)
@@ -254,6 +716,7 @@ def gather_keys(meraki, module):
         iterate_devices(meraki, datalist)
     meraki.resource_iterator(networkid=params['networkId'])
     #get_network_elements(meraki,params['networkId'])
+    meraki.build_url()
     return meraki.result
 
 
@@ -269,10 +732,15 @@ def main():
     argument_spec = meraki_argument_spec()
     argument_spec.update(
         dict(
-            organization=dict(type='str', required=True),
+            organization=dict(type='str'),
             networkid=dict(type='str', ),
             serial=dict(type='str'),
-            networkname=dict(type='str')
+            networkname=dict(type='str'),
+            serials=dict(type='list'),
+            networknames=dict(type='list'),
+            scope=dict(type='str', default='network', choices=['network', 'organization', 'all']),
+            org_filter=dict(type='str'),
+            org_concurrency=dict(type='int', default=4),
             #config=dict(type='list',elements='dict',options=device_conf_spec),
             #intent_state=dict(type='str', choices=['add', 'remove']),
         )
@@ -281,16 +749,20 @@ def main():
     module = AnsibleModule(
         argument_spec=argument_spec,
         mutually_exclusive=[
-            ['networkid','networkname'],
-            ['networkid','serial'],
-            ['networkname','serial'],
+            ['networkid', 'networkname', 'serial', 'serials', 'networknames'],
         ],
-        required_one_of=[
-            ['networkid','serial', 'networkname'],
+        required_if=[
+            ['scope', 'network', ['networkid','serial', 'networkname', 'serials', 'networknames'], True],
+            ['scope', 'network', ['organization']],
+            ['scope', 'organization', ['organization']],
         ]
     )
-    meraki = DashApi(module)
-    results = gather_keys(meraki, module)
+    meraki = dash_api(module)
+    try:
+        results = gather_keys(meraki, module)
+        meraki.finish()
+    finally:
+        meraki.release()
     meraki.check_api_failure()
     module.exit_json(**results)
 
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+lookup: meraki_snapshot
+short_description: queries the snapshot store written by meraki_network_facts
+description:
+    - Answers questions like "which device sees this MAC" from the SQLite
+      snapshot that meraki_network_facts writes with its I(snapshot) option,
+      locally and without calling the dashboard API.
+    - Every term is one FIELD=VALUE query against I(table), its matching rows
+      are returned as one list per term.
+options:
+    _terms:
+        description:
+            - FIELD=VALUE queries. Indexed fields are, per table,
+              organizations id, name; networks id, organizationId, name;
+              devices serial, networkId, mac, ip; clients serial, networkId,
+              mac, ip; vlans and routes networkId.
+        required: True
+    snapshot:
+        description:
+            - path of the snapshot file, as given to meraki_network_facts.
+        type: path
+        required: True
+    table:
+        description:
+            - table queried, clients rows also carry the model and name of
+              the device that saw them and the name of its network.
+        type: str
+        choices: ['organizations', 'networks', 'devices', 'clients', 'vlans', 'routes']
+        default: clients
+'''
+
+EXAMPLES = '''
+- name: which device sees a MAC
+  debug:
+    msg: "{{ lookup('meraki_snapshot', 'mac=24:e9:b3:26:1e:03',
+             snapshot='~/.ansible/meraki_snapshot.db', wantlist=True) }}"
+
+- name: devices of a network
+  debug:
+    msg: "{{ lookup('meraki_snapshot', 'networkId=N_1234', table='devices',
+             snapshot='~/.ansible/meraki_snapshot.db', wantlist=True) }}"
+'''
+
+RETURN = '''
+_raw:
+    description:
+        - per term, the matching rows; the indexed columns, the time the row
+          was collected (updated, seconds since the epoch) and the dashboard
+          payload under data.
+    type: list
+'''
+
+import json
+import os
+import sqlite3
+
+from ansible.errors import AnsibleError
+from ansible.plugins.lookup import LookupBase
+
+#queryable fields per table, and the column each one filters on
+FIELDS = {
+    'organizations': {'id': 'id', 'name': 'name'},
+    'networks': {'id': 'id', 'organizationId': 'organizationId', 'name': 'name'},
+    'devices': {'serial': 'serial', 'networkId': 'networkId', 'mac': 'mac', 'ip': 'lanIp'},
+    'clients': {'serial': 'serial', 'networkId': 'networkId', 'mac': 'mac', 'ip': 'ip'},
+    'vlans': {'networkId': 'networkId'},
+    'routes': {'networkId': 'networkId'},
+}
+
+#clients are returned with the device that saw them and its network
+CLIENTS = '''SELECT clients.*, devices.model AS model, devices.name AS deviceName,
+    networks.name AS networkName FROM clients
+    LEFT JOIN devices ON devices.serial = clients.serial
+    LEFT JOIN networks ON networks.id = clients.networkId
+    WHERE clients.%s = ?'''
+
+
+class LookupModule(LookupBase):
+
+    def run(self, terms, variables=None, **kwargs):
+        self.set_options(var_options=variables, direct=kwargs)
+        path = self.get_option('snapshot')
+        table = self.get_option('table')
+        if not path:
+            raise AnsibleError('meraki_snapshot: the snapshot option is required')
+        path = os.path.expanduser(path)
+        if not os.path.exists(path):
+            raise AnsibleError('meraki_snapshot: no snapshot at %s' % path)
+
+        db = sqlite3.connect(path)
+        db.row_factory = sqlite3.Row
+        try:
+            return [self.query(db, table, term) for term in terms]
+        except sqlite3.Error as e:
+            raise AnsibleError('meraki_snapshot: %s: %s' % (path, str(e)))
+        finally:
+            db.close()
+
+    def query(self, db, table, term):
+        #rows of TABLE matching the FIELD=VALUE query TERM
+        field, sep, value = term.partition('=')
+        field = field.strip()
+        if not sep or field not in FIELDS[table]:
+            raise AnsibleError('meraki_snapshot: %s is not one of %s=VALUE for table %s'
+                % (term, '|'.join(sorted(FIELDS[table])), table))
+        column = FIELDS[table][field]
+        value = value.strip()
+        if column == 'mac':
+            value = value.lower()
+        if table == 'clients':
+            sql = CLIENTS % column
+        else:
+            sql = 'SELECT * FROM %s WHERE %s = ?' % (table, column)
+        rows = []
+        for row in db.execute(sql, (value,)):
+            row = dict(zip(row.keys(), row))
+            if row.get('data') is not None:
+                row['data'] = json.loads(row['data'])
+            rows.append(row)
+        return rows
@@ -1,9 +1,29 @@
 import json
+import os
+import errno
+import fcntl
+import hashlib
+import heapq
+import io
+import itertools
 import requests
-import httplib
 import urllib3
-from ansible.module_utils import api
-from ansible.module_utils.basic import *
+import random
+from array import array
+import threading
+import time
+from ansible.module_utils.six import string_types
+from ansible.module_utils.six.moves.urllib.parse import urlsplit, urljoin, parse_qsl
+
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+#Ansible ships and imports this file afresh for every task, so only what
+#every run needs is imported here. multiprocessing.pool, tempfile and gzip
+#are imported where they are used, the asyncio transport by dash_api().
 
 
 def meraki_argument_spec():
@@ -13,11 +33,841 @@ def meraki_argument_spec():
     api_key=dict(type='str', required=True),
     resources=dict(type='list',
         #choices=['clients', 'uplinks', 'switchports', 'neighbors', 'networks', 'devices'].items,
-        default=['clients', 'uplinks', 'switchports', 'neighbors', 'networks', 'devices'],
+        default=['clients', 'uplinks', 'switchPorts', 'neighbors', 'networks', 'devices'],
         ),
     headers=dict(type='bool', default=False),
+    pool_size=dict(type='int', default=10),
+    keepalive=dict(type='bool', default=True),
+    compression=dict(type='bool', default=True),
+    max_concurrency=dict(type='int', default=1),
+    rate_limit=dict(type='float', default=5.0),
+    max_retries=dict(type='int', default=3),
+    cache=dict(type='str', default='bypass', choices=['use', 'refresh', 'bypass']),
+    cache_dir=dict(type='path', default='~/.ansible/meraki_cache'),
+    cache_ttl=dict(type='dict', default={}),
+    cache_size=dict(type='int', default=100),
+    output=dict(type='str', default='facts', choices=['facts', 'ndjson', 'ndjson.gz']),
+    output_dir=dict(type='path', default='~/.ansible/meraki_output'),
+    per_page=dict(type='int'),
+    delta=dict(type='bool', default=False),
+    timeout=dict(type='float', default=20.0),
+    endpoint_timeouts=dict(type='dict', default={}),
+    trace_file=dict(type='path'),
+    pin_shard=dict(type='bool', default=True),
+    serial_index=dict(type='bool', default=True),
+    transport=dict(type='str', default='sync', choices=['sync', 'async']),
+    resume=dict(type='bool', default=False),
+    clients_output=dict(type='str', default='raw', choices=['raw', 'rollup', 'both']),
+    top_talkers=dict(type='int', default=10),
+    client_window=dict(type='int', default=0),
+    snapshot=dict(type='path'),
     )
 
+def dash_api(module):
+    #DashApi for the module's transport option. The asyncio transport needs
+    #Python 3 and aiohttp, so meraki_async is only imported when selected.
+    if module.params.get('transport') == 'async':
+        try:
+            from ansible.module_utils.meraki_async import AsyncDashApi
+        except (ImportError, SyntaxError) as e:
+            module.fail_json(msg='transport async requires Python 3.5+ and aiohttp: %s' % str(e))
+        return AsyncDashApi(module)
+    return DashApi(module)
+
+#default seconds a cached response stays valid, per endpoint class.
+#inventory style collections change rarely, client and uplink stats often.
+CACHE_TTL = {
+    'organizations': 86400,
+    'inventory': 3600,
+    'networks': 3600,
+    'devices': 3600,
+    'clients': 300,
+    'uplink': 300,
+    'default': 600,
+}
+
+#per device endpoints the dashboard serves for each model family, requests
+#for any other family/endpoint pair only return 400/404 and are not planned
+MODEL_CAPABILITIES = {
+    'MX': ['clients', 'uplinks'],
+    'Z': ['clients', 'uplinks'],
+    'MS': ['clients', 'switchPorts'],
+    'MR': ['clients'],
+    'MG': ['uplinks'],
+    'MV': [],
+}
+
+def model_family(model):
+    #'MX100' -> 'MX', 'MS220-8P' -> 'MS', 'Z3' -> 'Z'
+    model = (model or '').upper()
+    if model.startswith('Z'):
+        return 'Z'
+    return model[:2]
+
+#endpoint classes whose collections are paged with Link rel=next headers
+PAGINATED = ['organizations', 'networks', 'inventory', 'devices', 'clients']
+
+def read_json_file(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def update_json_file(path, updates, prune=None):
+    #merge UPDATES into the JSON object stored at PATH, dropping the keys
+    #PRUNE(key) is true for. The read-merge-write happens under the
+    #directory's lock file and the write is atomic, so parallel Ansible
+    #forks do not lose each other's updates.
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    lockfile = open(os.path.join(directory, '.lock'), 'a')
+    fcntl.flock(lockfile, fcntl.LOCK_EX)
+    try:
+        data = read_json_file(path)
+        if prune is not None:
+            data = dict((k, v) for k, v in data.items() if not prune(k))
+        data.update(updates)
+        import tempfile
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+    finally:
+        lockfile.close()
+
+def iter_json(response, buffered=False):
+    #items of a JSON array RESPONSE requested with stream=True, a JSON
+    #object is its own only item. With ijson installed they are decoded one
+    #at a time as the body comes off the socket, or from memory when the
+    #body was read in full already (BUFFERED). Without ijson the body is
+    #read and decoded in full first.
+    if not HAS_IJSON:
+        payload = response.json()
+        return iter(payload if isinstance(payload, list) else [payload])
+    if buffered:
+        body = io.BytesIO(response.content)
+    else:
+        response.raw.decode_content = True
+        body = response.raw
+    events = ijson.parse(body, use_float=True)
+    first = next(events)
+    prefix = 'item' if first[1] == 'start_array' else ''
+    return ijson.items(itertools.chain([first], events), prefix)
+
+#errors raised while a streamed body is read and decoded
+STREAM_ERRORS = (ValueError, EnvironmentError, urllib3.exceptions.HTTPError,
+    requests.RequestException)
+if HAS_IJSON:
+    STREAM_ERRORS += (ijson.JSONError,)
+
+def resource_class(path):
+    #endpoint class of a URL path, the last collection name in it.
+    #'/devices/[serial]/clients?timespan=86400' -> 'clients'
+    #'/networks/[networkId]' -> 'networks'
+    parts = path.split('?')[0].strip('/').split('/')
+    if len(parts) % 2:
+        return parts[-1]
+    return parts[-2]
+
+class TokenBucket:
+    #client side request rate limiter, one bucket is shared by every
+    #request (and every worker thread) of a module run.
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        #credit the tokens earned since the last take() or pause()
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self):
+        #take a request token, returns 0 or the seconds to wait for one
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        #block until a request token is available
+        wait = self.take()
+        while wait:
+            time.sleep(wait)
+            wait = self.take()
+
+    def pause(self, seconds):
+        #drain the bucket so that no thread sends for the next SECONDS.
+        #Pauses that overlap (429s answered together) extend to the latest
+        #deadline, they do not add up.
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+class Record(object):
+    #compact read-only view of a dashboard dict, only the fields named in
+    #__slots__ are kept, so no per-record __dict__ or unused keys
+    __slots__ = ()
+
+    def __init__(self, item):
+        for field in self.__slots__:
+            setattr(self, field, item.get(field))
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.__slots__)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+            ', '.join('%s=%r' % (f, getattr(self, f)) for f in self.__slots__))
+
+class Organization(Record):
+    __slots__ = ('id', 'name')
+
+class Network(Record):
+    __slots__ = ('id', 'name', 'organizationId')
+
+class Device(Record):
+    #network devices and organization inventory entries
+    __slots__ = ('serial', 'model', 'networkId', 'mac', 'name')
+
+class ClientTable(object):
+    #columnar store of a device's clients: one list per projected field and
+    #float arrays for usage, instead of one dict tree per client
+    __slots__ = ('columns', 'sent', 'recv')
+    COLUMNS = ('id', 'mac', 'ip', 'vlan', 'description', 'mdnsName', 'dhcpHostname', 'switchport')
+
+    def __init__(self, clients=()):
+        self.columns = dict((c, []) for c in self.COLUMNS)
+        self.sent = array('d')
+        self.recv = array('d')
+        for client in clients:
+            self.append(client)
+
+    MISSING = object()
+
+    def append(self, client):
+        for c in self.COLUMNS:
+            self.columns[c].append(client.get(c, self.MISSING))
+        usage = client.get('usage') or {}
+        self.sent.append(usage.get('sent') or 0.0)
+        self.recv.append(usage.get('recv') or 0.0)
+
+    def __len__(self):
+        return len(self.sent)
+
+    def rows(self):
+        #clients as the dashboard returned them
+        for i in range(len(self)):
+            row = dict((c, self.columns[c][i]) for c in self.COLUMNS
+                if self.columns[c][i] is not self.MISSING)
+            row['usage'] = {'sent': self.sent[i], 'recv': self.recv[i]}
+            yield row
+
+    def to_list(self):
+        return list(self.rows())
+
+#smallest client timespan window, in seconds, and the response size a
+#window should stay under
+MIN_WINDOW = 3600
+WINDOW_BYTES = 2 * 1024 * 1024
+
+def mac_key(mac):
+    #MACs compared case-insensitively, the dashboard does not settle on a case
+    return mac.lower() if isinstance(mac, string_types) else mac
+
+def merge_clients(windows):
+    #one client list from the client lists of consecutive timespan WINDOWS,
+    #oldest first: usage is summed per MAC, the other fields are taken from
+    #the latest window the client was seen in
+    merged = {}
+    order = []
+    for clients in windows:
+        for client in clients:
+            usage = client.get('usage') or {}
+            mac = mac_key(client.get('mac'))
+            seen = merged.get(mac)
+            if seen is None:
+                seen = merged[mac] = {'usage': {'sent': 0.0, 'recv': 0.0}}
+                order.append(mac)
+            total = seen['usage']
+            seen.update(client)
+            seen['usage'] = {'sent': total['sent'] + (usage.get('sent') or 0.0),
+                'recv': total['recv'] + (usage.get('recv') or 0.0)}
+    return [merged[mac] for mac in order]
+
+class MergedResponse(object):
+    #stands in for the response of a windowed clients request, the payload
+    #was merged from the responses of its windows
+    status_code = 200
+    links = {}
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.headers = {}
+
+    def json(self):
+        return self.payload
+
+def client_rollup(tables, top=10):
+    #usage rollup of one network's ClientTables, TABLES keyed by device
+    #serial. Computed from the table columns: per-device totals are sums
+    #over the usage arrays, then every MAC, in whatever case, is counted
+    #once (a client seen by an MS and an MR keeps the larger of the usages
+    #reported) for the network totals, per-VLAN totals and the TOP talkers.
+    devices = {}
+    best = {}
+    for serial, table in tables.items():
+        sent, recv = table.sent, table.recv
+        devices[serial] = {'clients': len(table), 'sent': round(sum(sent), 3),
+            'recv': round(sum(recv), 3)}
+        for i, mac in enumerate(table.columns['mac']):
+            mac = mac_key(mac)
+            seen = best.get(mac)
+            if seen is None or sent[i] + recv[i] > seen[0].sent[seen[1]] + seen[0].recv[seen[1]]:
+                best[mac] = (table, i)
+    vlans = {}
+    for table, i in best.values():
+        vlan = table.columns['vlan'][i]
+        vlan = 'none' if vlan is None or vlan is ClientTable.MISSING else str(vlan)
+        entry = vlans.setdefault(vlan, {'clients': 0, 'sent': 0.0, 'recv': 0.0})
+        entry['clients'] += 1
+        entry['sent'] += table.sent[i]
+        entry['recv'] += table.recv[i]
+    for entry in vlans.values():
+        entry['sent'] = round(entry['sent'], 3)
+        entry['recv'] = round(entry['recv'], 3)
+    talkers = []
+    for table, i in heapq.nlargest(top, best.values(), key=lambda r: r[0].sent[r[1]] + r[0].recv[r[1]]):
+        row = dict((c, table.columns[c][i]) for c in ('mac', 'ip', 'vlan', 'description')
+            if table.columns[c][i] is not ClientTable.MISSING)
+        row['sent'] = table.sent[i]
+        row['recv'] = table.recv[i]
+        talkers.append(row)
+    return {'clients': len(best),
+        'sent': round(sum(t.sent[i] for t, i in best.values()), 3),
+        'recv': round(sum(t.recv[i] for t, i in best.values()), 3),
+        'devices': devices, 'vlans': vlans, 'top_talkers': talkers}
+
+class Pages:
+    #lazily fetched paginated collection. Records are pulled one page at a
+    #time as iteration reaches them and kept, so a lookup can stop as soon
+    #as its match is found and later lookups re-read nothing.
+    #A page may be a generator over a streamed body (PAGEURL is then the
+    #URL of the first page), its records are then read off the socket one
+    #at a time as well.
+    def __init__(self, records, nexturl, fetch_page, on_complete=None, pageurl=None):
+        self.records = []
+        self.pending = iter(records)
+        self.stream = records if hasattr(records, 'close') else None
+        self.pageurl = pageurl
+        self.taken = 0
+        self.nexturl = nexturl
+        self.fetch_page = fetch_page
+        self.on_complete = on_complete
+
+    END = object()
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i < len(self.records):
+                yield self.records[i]
+                i += 1
+                continue
+            if self.pending is None:
+                #suspended: request the page again, skipping what was read
+                page, self.nexturl = self.fetch_page(self.pageurl)
+                self.stream = page if hasattr(page, 'close') else None
+                self.pending = itertools.islice(page, self.taken, None)
+            record = next(self.pending, self.END)
+            if record is not self.END:
+                self.records.append(record)
+                self.taken += 1
+                continue
+            self.stream = None
+            if self.nexturl is None:
+                if self.on_complete is not None:
+                    on_complete, self.on_complete = self.on_complete, None
+                    on_complete(self.records)
+                return
+            self.pageurl, self.taken = self.nexturl, 0
+            page, self.nexturl = self.fetch_page(self.nexturl)
+            self.stream = page if hasattr(page, 'close') else None
+            self.pending = iter(page)
+
+    def suspend(self):
+        #stop reading a streamed page part way, closing its response so the
+        #connection goes back to the pool. Iterating on requests the page
+        #again and skips the records already taken from it.
+        if self.stream is not None and self.pageurl is not None:
+            self.stream.close()
+            self.stream = self.pending = None
+
+    def complete(self):
+        #read every remaining page, returns the whole collection as a list
+        for record in self:
+            pass
+        return self.records
+
+class ResponseCache:
+    #on-disk cache of dashboard responses, shared by every task and host of
+    #a playbook. Entries are keyed by a hash of API key + organization + API
+    #path, so they survive a change of shard host, written atomically and
+    #guarded by a lock file so parallel Ansible forks can use the same
+    #directory. Oldest entries are evicted past MAX_MB when a run that wrote
+    #to the cache closes it.
+    def __init__(self, path, api_key, ttl=None, max_mb=100, organization=None):
+        self.path = os.path.expanduser(path)
+        self.keyhash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        self.organization = str(organization or '')
+        self.ttl = dict(CACHE_TTL)
+        self.ttl.update(ttl or {})
+        self.max_bytes = int(max_mb) * 1024 * 1024
+        self.written = False
+        try:
+            os.makedirs(self.path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _key(self, url):
+        #organization and API path + query of URL, whatever host it names
+        parts = urlsplit(url)
+        return '%s:%s?%s' % (self.organization, parts.path, parts.query)
+
+    def _file(self, key):
+        name = hashlib.sha256((self.keyhash + key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name + '.json')
+
+    def _lock(self, mode):
+        lockfile = open(os.path.join(self.path, '.lock'), 'a')
+        fcntl.flock(lockfile, mode)
+        return lockfile
+
+    def get(self, url, cls='default'):
+        #cached payload for URL, or None when missing or older than the TTL
+        #of its endpoint class CLS
+        key = self._key(url)
+        ttl = self.ttl.get(cls, self.ttl['default'])
+        lockfile = self._lock(fcntl.LOCK_SH)
+        try:
+            with open(self._file(key)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        finally:
+            lockfile.close()
+        if entry.get('key') != key or time.time() - entry.get('time', 0) > ttl:
+            return None
+        return entry['body']
+
+    def put(self, url, payload):
+        key = self._key(url)
+        lockfile = self._lock(fcntl.LOCK_EX)
+        try:
+            import tempfile
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'key': key, 'time': time.time(), 'body': payload}, f)
+            os.rename(tmp, self._file(key))
+            self.written = True
+        finally:
+            lockfile.close()
+
+    def close(self):
+        #evict once at the end of a run that wrote entries
+        if not self.written:
+            return
+        lockfile = self._lock(fcntl.LOCK_EX)
+        try:
+            self._evict()
+        finally:
+            lockfile.close()
+        self.written = False
+
+    def _evict(self):
+        #drop least recently written entries until the cache fits MAX_MB
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            st = os.stat(os.path.join(self.path, name))
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+class RequestStats:
+    #per endpoint class call counts, bytes and latencies of every request,
+    #summarized as p50/p95/p99 under the 'perf' fact. Requests that raised
+    #(timeouts, connection errors) are recorded with the exception name as
+    #their status and counted as errors, 429/5xx answers that were retried
+    #as retries. Each request can also be appended to a trace file as one
+    #JSON line.
+    def __init__(self, trace_file=None):
+        self.lock = threading.Lock()
+        self.classes = {}
+        self.trace = None
+        if trace_file:
+            self.trace = open(os.path.expanduser(trace_file), 'a')
+
+    def record(self, cls, url, status, size, ttfb, total, started):
+        with self.lock:
+            entry = self._entry(cls)
+            entry['calls'] += 1
+            if not isinstance(status, int):
+                entry['errors'] += 1
+            entry['bytes'] += size
+            entry['ttfb'].append(ttfb)
+            entry['total'].append(total)
+            if self.trace is not None:
+                self.trace.write(json.dumps({'class': cls, 'url': url, 'status': status,
+                    'bytes': size, 'ttfb': round(ttfb, 6), 'total': round(total, 6),
+                    'start': round(started, 6)}) + '\n')
+
+    def retry(self, cls):
+        #count a retried answer of endpoint class CLS, from any thread
+        with self.lock:
+            self._entry(cls)['retries'] += 1
+
+    def _entry(self, cls):
+        return self.classes.setdefault(cls, {'calls': 0, 'errors': 0, 'retries': 0,
+            'bytes': 0, 'ttfb': [], 'total': []})
+
+    def _histogram(self, values):
+        #nearest-rank percentiles in seconds
+        values = sorted(values)
+        summary = {}
+        for p in (50, 95, 99):
+            rank = max(0, int(-(-p * len(values) // 100)) - 1)
+            summary['p%d' % p] = round(values[rank], 4)
+        summary['max'] = round(values[-1], 4)
+        return summary
+
+    def summary(self):
+        perf = {}
+        with self.lock:
+            for cls, entry in self.classes.items():
+                perf[cls] = {'calls': entry['calls'], 'errors': entry['errors'],
+                    'retries': entry['retries'], 'bytes': entry['bytes'],
+                    'ttfb': self._histogram(entry['ttfb']),
+                    'total': self._histogram(entry['total'])}
+            if self.trace is not None:
+                self.trace.close()
+                self.trace = None
+        return perf
+
+class DeltaState:
+    #ETag and content hash of every resource returned by the previous runs,
+    #kept per API key in the cache directory. Like response cache entries
+    #they are keyed by organization + API path, so they survive a change of
+    #shard host or per_page. Forks merge their updates into the file under
+    #the cache lock, so parallel tasks do not lose each other's.
+    def __init__(self, path, api_key, organization=None):
+        self.path = os.path.expanduser(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+        keyhash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        self.file = os.path.join(self.path, 'delta-' + keyhash[:16] + '.json')
+        self.organization = str(organization or '')
+        self.state = read_json_file(self.file)
+        self.updates = {}
+
+    def _key(self, resource):
+        #organization and API path + query of RESOURCE, e.g. '/networks/N_1'
+        return '%s:%s' % (self.organization, resource)
+
+    def headers(self, resource):
+        #conditional request headers for RESOURCE
+        etag = self.state.get(self._key(resource), {}).get('etag')
+        if etag:
+            return {'If-None-Match': etag}
+        return {}
+
+    def changed(self, resource, payload, etag=None):
+        #record the new hash / ETag of RESOURCE, True when it differs from
+        #last run
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+        key = self._key(resource)
+        previous = self.state.get(key, {})
+        if etag is None and previous.get('hash') == digest:
+            etag = previous.get('etag')
+        self.updates[key] = {'hash': digest, 'etag': etag}
+        return previous.get('hash') != digest
+
+    def save(self):
+        #entries of earlier versions, keyed by full URL, are dropped
+        update_json_file(self.file, self.updates, prune=lambda key: '://' in key)
+
+class NdjsonSink:
+    #streams endpoint payloads to a local NDJSON (optionally gzip'd) file as
+    #they arrive, one {"key": ..., "record": ...} line per list element, so
+    #collected data does not have to be held in memory or in ansible_facts.
+    def __init__(self, path, compress=False):
+        self.path = path
+        if compress:
+            import gzip
+            self.handle = gzip.open(path, 'wb')
+        else:
+            self.handle = open(path, 'wb')
+        self.records = 0
+
+    def write(self, key, payload):
+        #returns the manifest entry (record count, bytes) for KEY
+        if not isinstance(payload, list):
+            payload = [payload]
+        return self.write_records(key, payload)
+
+    def write_records(self, key, records):
+        #write every record of the iterable RECORDS as it is produced
+        count = size = 0
+        for record in records:
+            line = (json.dumps({'key': key, 'record': record}) + '\n').encode('utf-8')
+            self.handle.write(line)
+            size += len(line)
+            count += 1
+        self.records += count
+        return {'records': count, 'bytes': size}
+
+    def close(self):
+        self.handle.close()
+        return {'path': self.path, 'records': self.records, 'bytes': os.path.getsize(self.path)}
+
+#tables of the snapshot store, one row per dashboard object, its full
+#payload as JSON in 'data'. Lookups filter on the indexed columns.
+SNAPSHOT_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS organizations (id TEXT PRIMARY KEY, name TEXT, updated REAL);
+CREATE TABLE IF NOT EXISTS networks (id TEXT PRIMARY KEY, organizationId TEXT, name TEXT,
+    data TEXT, updated REAL);
+CREATE TABLE IF NOT EXISTS devices (serial TEXT PRIMARY KEY, networkId TEXT, model TEXT,
+    mac TEXT, name TEXT, lanIp TEXT, data TEXT, updated REAL);
+CREATE TABLE IF NOT EXISTS clients (serial TEXT, networkId TEXT, mac TEXT, ip TEXT, vlan TEXT,
+    description TEXT, sent REAL, recv REAL, data TEXT, updated REAL);
+CREATE TABLE IF NOT EXISTS vlans (networkId TEXT, id TEXT, name TEXT, subnet TEXT,
+    applianceIp TEXT, data TEXT, updated REAL);
+CREATE TABLE IF NOT EXISTS routes (networkId TEXT, id TEXT, name TEXT, subnet TEXT,
+    gatewayIp TEXT, data TEXT, updated REAL);
+CREATE TABLE IF NOT EXISTS payloads (path TEXT PRIMARY KEY, data TEXT, updated REAL);
+CREATE INDEX IF NOT EXISTS networks_organization ON networks (organizationId);
+CREATE INDEX IF NOT EXISTS devices_network ON devices (networkId);
+CREATE INDEX IF NOT EXISTS devices_mac ON devices (mac);
+CREATE INDEX IF NOT EXISTS devices_ip ON devices (lanIp);
+CREATE INDEX IF NOT EXISTS clients_serial ON clients (serial);
+CREATE INDEX IF NOT EXISTS clients_network ON clients (networkId);
+CREATE INDEX IF NOT EXISTS clients_mac ON clients (mac);
+CREATE INDEX IF NOT EXISTS clients_ip ON clients (ip);
+CREATE INDEX IF NOT EXISTS vlans_network ON vlans (networkId);
+CREATE INDEX IF NOT EXISTS routes_network ON routes (networkId);
+'''
+
+class SnapshotStore:
+    #SQLite file holding the latest state of everything collected, for the
+    #meraki_snapshot lookup and other local consumers. Each collection
+    #replaces what an earlier run stored for the same network or device,
+    #lookup collections (organizations, networks, inventory) only update the
+    #fields they were read with. Nothing is committed until close(), so a
+    #failed run leaves the previous snapshot as it was. One store may be
+    #shared by the DashApis of an organization sweep.
+    def __init__(self, path):
+        import sqlite3
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.db.executescript(SNAPSHOT_SCHEMA)
+        self.lock = threading.Lock()
+        self.updated = time.time()
+        self.rows = {}
+
+    def write(self, path, payload, networkid=None):
+        #store the PAYLOAD of dashboard PATH, NETWORKID is the network a
+        #device's clients were collected for
+        parts = path.split('?')[0].strip('/').split('/')
+        if isinstance(payload, ClientTable):
+            payload = payload.to_list()
+        items = payload if isinstance(payload, list) else [payload]
+        items = [i.to_dict() if isinstance(i, Record) else i for i in items]
+        with self.lock:
+            if parts == ['organizations']:
+                for org in items:
+                    self._upsert('organizations', 'id', {'id': str(org.get('id')), 'name': org.get('name')})
+            elif parts[0] == 'organizations' and parts[2:] == ['networks']:
+                for network in items:
+                    self._upsert('networks', 'id', self._network(network))
+            elif parts[0] == 'organizations' and parts[2:] == ['inventory']:
+                for device in items:
+                    row = self._device(device)
+                    row.pop('lanIp')
+                    self._upsert('devices', 'serial', row)
+            elif parts[0] == 'networks' and len(parts) == 2:
+                row = self._network(payload)
+                row['data'] = json.dumps(payload)
+                self._upsert('networks', 'id', row)
+            elif parts[0] == 'networks' and parts[2:] == ['devices']:
+                self.db.execute('DELETE FROM devices WHERE networkId = ?', (parts[1],))
+                for device in items:
+                    row = self._device(device)
+                    row['data'] = json.dumps(device)
+                    self._upsert('devices', 'serial', row)
+            elif parts[0] == 'devices' and parts[2:] == ['clients']:
+                self.db.execute('DELETE FROM clients WHERE serial = ?', (parts[1],))
+                for client in items:
+                    usage = client.get('usage') or {}
+                    self._insert('clients', {'serial': parts[1], 'networkId': networkid,
+                        'mac': (client.get('mac') or '').lower() or None, 'ip': client.get('ip'),
+                        'vlan': self._text(client.get('vlan')), 'description': client.get('description'),
+                        'sent': usage.get('sent'), 'recv': usage.get('recv'),
+                        'data': json.dumps(client)})
+            elif parts[0] == 'networks' and parts[2:] in (['vlans'], ['staticRoutes']):
+                table, gateway = ('vlans', 'applianceIp') if parts[2] == 'vlans' else ('routes', 'gatewayIp')
+                self.db.execute('DELETE FROM %s WHERE networkId = ?' % table, (parts[1],))
+                for item in items:
+                    self._insert(table, {'networkId': parts[1], 'id': self._text(item.get('id')),
+                        'name': item.get('name'), 'subnet': item.get('subnet'),
+                        gateway: item.get(gateway), 'data': json.dumps(item)})
+            else:
+                self._upsert('payloads', 'path', {'path': path, 'data': json.dumps(payload)})
+
+    def close(self):
+        #commit and return the manifest: path and rows written per table
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+        return {'path': self.path, 'rows': self.rows}
+
+    def discard(self):
+        #close without committing, the previous snapshot stays as it was
+        with self.lock:
+            self.db.close()
+
+    def _network(self, network):
+        return {'id': network.get('id'), 'organizationId': self._text(network.get('organizationId')),
+            'name': network.get('name')}
+
+    def _device(self, device):
+        return {'serial': device.get('serial'), 'networkId': device.get('networkId'),
+            'model': device.get('model'), 'mac': (device.get('mac') or '').lower() or None,
+            'name': device.get('name'), 'lanIp': device.get('lanIp')}
+
+    def _text(self, value):
+        return None if value is None else str(value)
+
+    def _upsert(self, table, key, row):
+        #update the columns in ROW of the row matching ROW[KEY], insert it
+        #when there is none
+        row['updated'] = self.updated
+        columns = [c for c in row if c != key]
+        cursor = self.db.execute('UPDATE %s SET %s WHERE %s = ?' % (table,
+            ', '.join(c + ' = ?' for c in columns), key), [row[c] for c in columns] + [row[key]])
+        if cursor.rowcount:
+            self.rows[table] = self.rows.get(table, 0) + 1
+        else:
+            self._insert(table, row)
+
+    def _insert(self, table, row):
+        row['updated'] = self.updated
+        self.db.execute('INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(row),
+            ', '.join('?' * len(row))), list(row.values()))
+        self.rows[table] = self.rows.get(table, 0) + 1
+
+#module parameters that decide what a run collects, a journal is only
+#replayed by a run with the same values; journals not resumed within
+#JOURNAL_EXPIRY seconds are removed
+JOURNAL_IDENTITY = ['api_key', 'organization', 'scope', 'networkid', 'networkname',
+    'networknames', 'serial', 'serials', 'resources', 'timespan', 'per_page']
+JOURNAL_EXPIRY = 86400
+
+class Journal:
+    #checkpoint of a run: every completed endpoint payload is appended to a
+    #JSON lines file in the cache directory as it arrives. The file is named
+    #after a hash of the JOURNAL_IDENTITY parameters, so a rerun of a failed
+    #task finds the journal it left and replays its payloads instead of
+    #GETting them again, whatever its timeouts, concurrency or output. The
+    #journal is removed once a run completes.
+    def __init__(self, path, params):
+        self.path = os.path.expanduser(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+        identity = {}
+        for k in JOURNAL_IDENTITY:
+            value = params.get(k)
+            if isinstance(value, list):
+                value = sorted(str(v) for v in value)
+            identity[k] = value
+        digest = hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode('utf-8'))
+        self.file = os.path.join(self.path, 'journal-' + digest.hexdigest()[:16] + '.ndjson')
+        self.expire()
+        self.entries = {}
+        try:
+            with open(self.file) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        #the last line of a run killed mid-write
+                        continue
+                    self.entries[entry['path']] = entry['payload']
+        except (IOError, OSError):
+            pass
+        self.handle = open(self.file, 'a')
+
+    def expire(self):
+        #remove the journals of other runs left for longer than JOURNAL_EXPIRY
+        cutoff = time.time() - JOURNAL_EXPIRY
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if not name.startswith('journal-') or not name.endswith('.ndjson') or path == self.file:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def write(self, path, payload):
+        self.handle.write(json.dumps({'path': path, 'payload': payload}) + '\n')
+        self.handle.flush()
+
+    def close(self, completed=True):
+        self.handle.close()
+        if completed:
+            try:
+                os.remove(self.file)
+            except OSError:
+                pass
+
+class SweepFailure(Exception):
+    pass
+
+class SweepModule:
+    #AnsibleModule stand-in of one organization in a multi-org sweep, with
+    #that organization's params. fail_json() raises SweepFailure, so a
+    #failing organization is reported in the sweep summary instead of
+    #ending the whole module run. Failed requests pass the stdout collected
+    #so far as msg, the sweep reports DashApi.error for those instead.
+    def __init__(self, module, params):
+        self.module = module
+        self.params = params
+
+    def fail_json(self, **kwargs):
+        msg = kwargs.get('msg')
+        raise SweepFailure(msg if isinstance(msg, string_types) else 'API request failed')
+
 class DashApi:
     def __init__(self, module):
         self.module = module
@@ -25,23 +875,120 @@ class DashApi:
         self.headers = {"Content-Type": "application/json"}
         self.headers['x-cisco-meraki-api-key'] = self.params.get('api_key')
         self.baseurl = "https://" + self.params.get('dashboard') + "/api/v0"
+        #organizations live on a shard host (n126.meraki.com, ...) that the
+        #dashboard redirects to. A shard learnt by an earlier run is used
+        #right away, saving the redirect round trip and its TLS connection.
+        #Pins are kept per dashboard host and organization, like the
+        #response cache they are neither read nor written with cache bypass.
+        self.shards = None
+        self.shard_key = '%s/%s' % (self.params.get('dashboard'), self.params.get('organization') or '')
+        if self.params.get('pin_shard') and self.params.get('cache') != 'bypass':
+            self.shards = os.path.join(os.path.expanduser(self.params.get('cache_dir')), 'shards.json')
+            shard = read_json_file(self.shards).get(self.shard_key)
+            if shard:
+                self.baseurl = shard + "/api/v0"
         self.organization = self.params.get('organization')
+        #network and model of every serial resolved from an inventory, so a
+        #later serial scoped run can skip the inventory download. Like shard
+        #pins, the index is neither read nor written with cache bypass.
+        self.serials = None
+        if self.params.get('serial_index') and self.organization \
+                and self.params.get('cache') != 'bypass':
+            self.serials = os.path.join(os.path.expanduser(self.params.get('cache_dir')),
+                'serials-' + str(self.organization) + '.json')
         self.orgname = self.params.get('organization_name')
         self.networkId = self.params.get('networkid')
         self.networkname = self.params.get('networkname')
         self.serial = self.params.get('serial')
         self.timeout = self.params.get('timeout')
+        #endpoint_timeouts is a free-form dict, its values are checked here
+        try:
+            self.endpoint_timeouts = dict((k, float(v))
+                for k, v in (self.params.get('endpoint_timeouts') or {}).items())
+        except (TypeError, ValueError):
+            module.fail_json(msg='endpoint_timeouts values must be numbers of seconds, got %s'
+                % self.params.get('endpoint_timeouts'))
+        #timespan is a free-form string sent as is, it must be seconds
         self.timespan = self.params.get('timespan')
+        try:
+            float(self.timespan)
+        except (TypeError, ValueError):
+            module.fail_json(msg='timespan must be a number of seconds, got %s' % self.timespan)
         self.resourceslist = self.params.get('resources')
-        self.result = {'ansible_facts':{'stdout': {}, 'api-endpoints': {} }}
+        self.result = {'ansible_facts':{'stdout': {}, 'api-endpoints': {},
+            'api-requests': {'issued': 0, 'deduplicated': 0, 'retried': 0, 'cached': 0,
+                'pruned': 0, 'resumed': 0} }}
         self.result_key = ''
+        #URL and message of the request that failed the run
+        self.error = None
+        self.group = None
         self.urldict={}
+        self.responses={}
+        self.streamed={}
+        self.client_tables={}
+        self.unchanged=set()
+        self.indexes={}
+        self.lock = threading.Lock()
+        self.stats = RequestStats(self.params.get('trace_file'))
+        self.bucket = None
+        if self.params.get('rate_limit'):
+            self.bucket = TokenBucket(self.params.get('rate_limit'))
+        self.window = self.params.get('client_window')
+        self.cache = None
+        self.cache_hits = {}
+        if self.params.get('cache') in ('use', 'refresh'):
+            self.cache = ResponseCache(self.params.get('cache_dir'), self.params.get('api_key'),
+                ttl=self.params.get('cache_ttl'), max_mb=self.params.get('cache_size'),
+                organization=self.params.get('organization'))
 
         try:
             requests.packages.urllib3.disable_warnings()
         except AttributeError:
             urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+        #one long-lived session per run, so every GET to the dashboard/shard
+        #host reuses a pooled connection instead of a new TCP + TLS handshake
+        if self.params.get('compression'):
+            self.headers['Accept-Encoding'] = 'gzip'
+        else:
+            self.headers['Accept-Encoding'] = 'identity'
+        if not self.params.get('keepalive'):
+            self.headers['Connection'] = 'close'
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.verify = False
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.params.get('pool_size'),
+            pool_maxsize=self.params.get('pool_size'))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.delta = None
+        if self.params.get('delta'):
+            self.delta = DeltaState(self.params.get('cache_dir'), self.params.get('api_key'),
+                organization=self.params.get('organization'))
+            self.result['ansible_facts']['changed_resources'] = []
+
+        #with resume, payloads are journaled so that a failed run can be
+        #picked up where it stopped; sweeps journal per organization
+        self.journal = None
+        if self.params.get('resume') and self.organization:
+            self.journal = Journal(self.params.get('cache_dir'), self.params)
+
+        #a multi-org sweep (no organization) writes one file per organization
+        self.sink = None
+        if self.params.get('output') != 'facts' and self.organization:
+            outdir = os.path.expanduser(self.params.get('output_dir'))
+            if not os.path.isdir(outdir):
+                os.makedirs(outdir, 0o700)
+            name = 'meraki-%s-%s-%d.%s' % (self.organization, time.strftime('%Y%m%d%H%M%S'),
+                os.getpid(), self.params.get('output'))
+            self.sink = NdjsonSink(os.path.join(outdir, name),
+                compress=self.params.get('output').endswith('.gz'))
+
+        self.snapshot = None
+        if self.params.get('snapshot'):
+            self.snapshot = SnapshotStore(self.params.get('snapshot'))
+
     def dec_network_elements(self):
         return dict(
         {'neighbors':self.get_device,
@@ -78,26 +1025,34 @@ class DashApi:
         })
 
     def device_elements(self):
+        #valid models per element are listed in MODEL_CAPABILITIES
         return dict({
         'clients':{
             'action':self.get_client,
-            'model':['MS','MX','MR'],
             },
         'uplinks':{
             'action':self.get_uplink,
-            'model':['MX'],
             },
         'switchPorts':{
             'action':self.get_switchport,
-             'model':['MX'],
             },
          }
         )
 
+    def capable(self, model, qkey):
+        #True when the model family supports device element QKEY, impossible
+        #requests are counted as pruned instead of being planned
+        if qkey in MODEL_CAPABILITIES.get(model_family(model), []):
+            return True
+        self.result['ansible_facts']['api-requests']['pruned'] += 1
+        return False
+
     def resource_iterator(self,serial=None, networkid=None, model=None):
-        d = self.device_elements()
-        n = self.network_elements()
+        #resource names are matched case-insensitively ('switchports')
+        d = dict((k.lower(), v) for k, v in self.device_elements().items())
+        n = dict((k.lower(), v) for k, v in self.network_elements().items())
         for item in self.resourceslist:
+            item = item.lower()
             if (item in d.keys()) and (serial is not None) and (model is not None):
                 d[item]['action'](serial=serial, model=model)
             elif (item in n.keys()) and (networkid is not None):
@@ -111,98 +1066,180 @@ class DashApi:
 
     QUERY = '''
     '''
-    def _query (self, datalist, fkey, rrecord, alias=None):
+    def _query (self, datalist, fkey, record, unique=True):
         NOTES = '''
-        (data, {'networkId':'L_567890'}, ['serial','model'], alias='mac')
+        (data, {'networkId':'L_567890'}, Device, unique=False)
 
-        takes in a list and uses FKEY dictionary to find matching k,v pair
-        returns data values that match values in RRECORD list,
-        ALIAS is used to create unique top-level keys when needed.
+        takes in a list and uses FKEY dictionary to find matching k,v pair,
+        returns the matches projected into RECORD objects (Device, Network,
+        Organization), which only keep the fields named in their __slots__.
+        UNIQUE lookups (serial, name) stop reading a paginated collection at
+        the first match; no match fails the module.
 
-        above example will iterate dataset and match on {'networkId':'L_567890'}
-        it will iterate a through ['serial,'model'] and return respective values from dataset,
-        also the value for 'mac' key will be store and returned as top-level keys
+        above example will match on {'networkId':'L_567890'} and return
          [
-            {
-            "00:18:0a:85:94:58": [
-                {"serial": "Q2JN-XXXX-YYYY"},
-                {"model": "MX100"}
-            ]
-        },
-            {
-            "00:18:0a:85:96:c8": [
-                {"serial": "Q2JN-YYYY-ZZZZ"},
-                {"model": "MX100"}
-            ]
-        }
-       ]
+            Device(serial='Q2JN-XXXX-YYYY', model='MX100', networkId='L_567890',
+                   mac='00:18:0a:85:94:58', name=None),
+            Device(serial='Q2JN-YYYY-ZZZZ', model='MX100', networkId='L_567890',
+                   mac='00:18:0a:85:96:c8', name=None)
+        ]
         '''
-        if not isinstance(datalist, list):
-            newlist =[]
-            newlist.append(datalist)
-            datalist = newlist
-        d={}
-        l=[]
         [(k,v)] = fkey.items()
-        for item in datalist:
-            eachlist=[]
-            if item[k] == v:
-                for each in rrecord:
-                    if alias is None:
-                        d[v]={each:item[each]}
-                    else:
-                        eachlist.append({each:item[each]})
-                    if len(rrecord) > 1:
-                        d.update({item[alias]:eachlist})
-                l.append(d)
-                d = {}
+        if unique:
+            index = self._index(datalist, k, record, until=v)
+            self._settle(datalist)
+        else:
+            index = self._index(datalist, k, record)
+        l = index.get(v, [])
         if not l:
             self._query_err(value=v)
         return l
 
+    def _index (self, datalist, field, record, until=None):
+        #hash map of FIELD value -> matching RECORD objects of a fetched
+        #collection, projected once as the collection is read. Built once per
+        #(URL path, field), so later lookups on the same collection are O(1)
+        #and, with fetch() deduplication, never re-GET it.
+        #Pages are indexed lazily, with UNTIL set reading stops at its match.
+        #Lookup collections already hold RECORD objects, which are shared.
+        key = (self.resource, field)
+        if key not in self.indexes:
+            if not isinstance(datalist, (list, Pages)):
+                datalist = [datalist]
+            self.indexes[key] = [{}, iter(datalist)]
+        index, items = self.indexes[key]
+        if items is not None and (until is None or until not in index):
+            for item in items:
+                if not isinstance(item, Record):
+                    item = record(item)
+                value = getattr(item, field)
+                index.setdefault(value, []).append(item)
+                if until is not None and value == until:
+                    break
+            else:
+                self.indexes[key][1] = None
+        return index
+
+    def _settle (self, datalist):
+        #a lookup is answered: reading with ijson may have stopped mid-way
+        #through a streamed page, whose response is closed until needed
+        if isinstance(datalist, Pages) and HAS_IJSON:
+            datalist.suspend()
+
+    def _lookup (self, datalist, field, record, values):
+        #resolve many VALUES of FIELD in one pass over a collection, returns
+        #({value: first matching RECORD}, [values without a match]). Reading
+        #stops once every value is found; misses do not fail the module.
+        found = {}
+        missing = []
+        for v in values:
+            matches = self._index(datalist, field, record, until=v).get(v)
+            if matches:
+                found[v] = matches[0]
+            elif v not in missing:
+                missing.append(v)
+        self._settle(datalist)
+        return found, missing
+
     def _query_err(self, value):
         self.module.fail_json(msg="Query value % s not found" %value)
         return
 
+    def networks_by_name(self, names):
+        # returns ({name: Network}, [names not found]) from Network Inventory
+        data = self.get_orgnetworks('query')
+        return self._lookup(data, 'name', Network, names)
+
+    def devices_by_serial(self, serials):
+        # returns ({serial: Device}, [serials not found]) from Organization Inventory
+        data = self.get_orginventory('query')
+        found, missing = self._lookup(data, 'serial', Device, serials)
+        if self.serials is not None:
+            #every device read so far goes into the serial index
+            seen = self.indexes[(self.resource, 'serial')][0]
+            updates = dict((serial, [d[0].networkId, d[0].model])
+                for serial, d in seen.items() if d[0].networkId)
+            if updates:
+                update_json_file(self.serials, updates)
+        return found, missing
+
+    def device_serial_query(self, serial):
+        # returns the Device record matching Serial and sets its networkId.
+        # A serial in the serial index is confirmed by one device lookup in
+        # its cached network; others, and devices that moved, are looked up
+        # in Organization Inventory.
+        device = None
+        cached = read_json_file(self.serials).get(serial) if self.serials else None
+        if cached:
+            device = self._device_lookup(cached[0], serial)
+        if device is None:
+            devices, missing = self.devices_by_serial([serial])
+            if missing:
+                self._query_err(value=serial)
+            device = devices[serial]
+        self.networkId = device.networkId
+        return device
+
+    def _device_lookup(self, network, serial):
+        #Device record of SERIAL in NETWORK, None when it is not there (any
+        #more) or the lookup fails. A 404 only means the index is stale, it
+        #is not recorded in api-endpoints as a failed request.
+        url = self._url('/networks/' + network + '/devices/' + serial)
+        self._count('issued')
+        try:
+            response = self._request(url)
+        except requests.RequestException as e:
+            if getattr(e.response, 'status_code', None) != 404:
+                self.result['ansible_facts']['api-endpoints'][url] = str(e)
+            return None
+        self.result['ansible_facts']['api-endpoints'][url] = response.status_code
+        try:
+            item = response.json()
+        except ValueError:
+            return None
+        if not isinstance(item, dict) or item.get('serial') != serial:
+            return None
+        return Device(item)
+
     def net_nameid_query(self, name):
         # returns an ID from Network Inventory matching Network Name
-        data = self.get_orgnetworks('query')
-        datalist = self._query(data, {'name':name}, ['id'])
-        self.networkId = datalist[0][name]['id']
+        networks, missing = self.networks_by_name([name])
+        if missing:
+            self._query_err(value=name)
+        self.networkId = networks[name].id
         return self.networkId
 
     def org_nameid_query(self, name):
         # returns an ID from Organization Inventory matching Org Name
         data = self.get_organizations('query')
-        datalist = self._query(data, {'name':name}, ['id'])
-        self.organization = str(datalist[0][name]['id'])
+        self.organization = str(self._query(data, {'name':name}, Organization)[0].id)
         return self.organization
 
     def device_idmodel_query(self, serial):
-        # returns  Model Number from Device Inventory matching Serial
-        data = self.get_networkdevices('query')
-        datalist = self._query(data, {'serial':serial}, ['model'])
-        keyname=datalist[0].keys()
-        topkey=str(keyname[0])
-        model = datalist[0][serial]['model']
-        return model
+        # returns  Model Number from Organization Inventory matching Serial
+        devices, missing = self.devices_by_serial([serial])
+        if missing:
+            self._query_err(value=serial)
+        return devices[serial].model
 
     def device_netid_query(self, network):
-        # returns an hash of Serial, Model from Device Inventory matching NetworkID
-        # mac address is used as top-level key
-        data = self.get_device('query')
-        datalist = self._query(data, {'networkId':network}, ['serial','model'], alias='mac')
-        keyname=datalist[0].keys()
-        topkey=str(keyname[0])
+        # returns Device records from Device Inventory matching NetworkID
+        data = self.get_device('query', networks=network)
+        datalist = self._query(data, {'networkId':network}, Device, unique=False)
         return datalist
 
+    def device_invid_query(self, network):
+        # returns Device records from Organization Inventory matching NetworkID,
+        # networks without devices return []
+        data = self.get_orginventory('query')
+        return self._index(data, 'networkId', Device).get(network, [])
+
     def net_serialid_query(self, serial):
         # returns Serial Number from Organization Inventory matching NetworkID
-        data = self.get_orginventory('query')
-        datalist = self._query(data, {'serial':serial}, ['networkId'])
-        keyname=datalist[0].keys()
-        topkey=str(keyname[0])
-        self.networkId = datalist[0][serial]['networkId']
+        devices, missing = self.devices_by_serial([serial])
+        if missing:
+            self._query_err(value=serial)
+        self.networkId = devices[serial].networkId
         return self.networkId
 
 
@@ -215,14 +1252,11 @@ class DashApi:
         #Return an array containing the uplink information for a device.
         #'https://dashboard.meraki.com/api/v0/networks/[networkId]/devices/[serial]/uplink'
 
-        d = self.device_elements()
-        if model[:2] in d[qkey]['model']:
+        results = None
+        if self.capable(model, qkey):
             if serial:
                 self.serial = serial
-            self.urldict[qkey + "-" + self.serial] = '/networks/'+ self.networkId + '/devices/'+ self.serial + '/uplink'
-            results = self.build_url()
-        else:
-            results = None
+            results = self.plan_url(qkey + "-" + self.serial, '/networks/'+ self.networkId + '/devices/'+ self.serial + '/uplink')
         return results
 
     def get_client (self, qkey='clients',serial='',model=''):
@@ -231,28 +1265,22 @@ class DashApi:
         #switchport is returned; otherwise the switchport field is null.
         #'https://dashboard.meraki.com/api/v0/devices/[serial]/clients?timespan=86400'
 
-        d = self.device_elements()
-        if model[:2] in d[qkey]['model']:
+        results = None
+        if self.capable(model, qkey):
             if serial:
                 self.serial = serial
-                self.urldict[qkey + "-" + self.serial] = '/devices/'+ self.serial +'/clients?timespan='+ self.timespan
-                results = self.build_url()
-        else:
-            results = None
+                results = self.plan_url(qkey + "-" + self.serial, '/devices/'+ self.serial +'/clients?timespan='+ self.timespan)
         return results
 
     def get_switchport (self, model, qkey='switchPorts',serial=''):
         #List the switch ports for a switch
         #'https://dashboard.meraki.com/api/v0/devices/[serial]/switchPorts'
 
-        d = self.device_elements()
-        if model[:2] in d[qkey]['model']:
+        results = None
+        if self.capable(model, qkey):
             if serial:
                 self.serial = serial
-                self.urldict[qkey] = '/devices/'+ self.serial + '/switchPorts'
-                results = self.build_url()
-        else:
-            results = None
+                results = self.plan_url(qkey + "-" + self.serial, '/devices/'+ self.serial + '/switchPorts')
         return results
 
     def get_device (self, qkey='network_neighbors', networks=''):
@@ -260,8 +1288,7 @@ class DashApi:
         #'https://dashboard.meraki.com/api/v0/networks/[networkId]/devices'
         if networks:
             self.networkId = networks
-        self.urldict[qkey] = '/networks/'+ self.networkId + '/devices'
-        results = self.build_url()
+        results = self.plan_url(qkey, '/networks/'+ self.networkId + '/devices')
         return results
 
     def get_ssid (self, qkey='ssids', networks=''):
@@ -269,8 +1296,7 @@ class DashApi:
         #'https://dashboard.meraki.com/api/v0/networks/[networkId]/ssids'
         if networks:
             self.networkId = networks
-        self.urldict[qkey] = '/networks/'+ self.networkId + '/ssids'
-        results = self.build_url()
+        results = self.plan_url(qkey, '/networks/'+ self.networkId + '/ssids')
         return results
 
     def get_network (self, qkey='network',networks=''):
@@ -278,8 +1304,7 @@ class DashApi:
         #'https://dashboard.meraki.com/api/v0/networks/[id]'
         if networks:
             self.networkId = networks
-        self.urldict[qkey] = '/networks/'+ self.networkId
-        results = self.build_url()
+        results = self.plan_url(qkey, '/networks/'+ self.networkId)
         return results
 
     def get_networkdevices(self, qkey='networkdevices',networks=''):
@@ -287,8 +1312,7 @@ class DashApi:
         #'https://dashboard.meraki.com/api/v0/networks/[networkId]/devices/[serial]'
         if networks:
             self.networkId = networks
-        self.urldict[qkey] = '/networks/'+ self.networkId + '/devices/'+ self.serial
-        results = self.build_url()
+        results = self.plan_url(qkey, '/networks/'+ self.networkId + '/devices/'+ self.serial)
         return results
 
 
@@ -297,8 +1321,7 @@ class DashApi:
         #'https://dashboard.meraki.com/api/v0/networks/[networkId]/staticRoutes'
         if networks:
             self.networkId = networks
-        self.urldict[qkey] = '/networks/'+ self.networkId + '/staticRoutes'
-        results = self.build_url()
+        results = self.plan_url(qkey, '/networks/'+ self.networkId + '/staticRoutes')
         return results
 
     def get_vlan (self, qkey='vlans',networks=''):
@@ -306,8 +1329,7 @@ class DashApi:
         #'https://dashboard.meraki.com/api/v0/networks/[networkId]/vlans'
         if networks:
             self.networkId = networks
-        self.urldict[qkey] = '/networks/'+ self.networkId +'/vlans'
-        results = self.build_url()
+        results = self.plan_url(qkey, '/networks/'+ self.networkId +'/vlans')
         return results
 
     def get_s2svpn (self, qkey='s2svpn', networks=''):
@@ -315,8 +1337,7 @@ class DashApi:
         #'https://dashboard.meraki.com/api/v0/networks/[id]/siteToSiteVpn'
         if networks:
             self.networkId = networks
-        self.urldict[qkey] = '/networks/'+ self.networkId + '/siteToSiteVpn'
-        results = self.build_url()
+        results = self.plan_url(qkey, '/networks/'+ self.networkId + '/siteToSiteVpn')
         return results
 
 
@@ -326,22 +1347,19 @@ class DashApi:
     def get_organizations (self, qkey='organizations'):
         #List the organizations that API key has privileges on
         #'https://dashboard.meraki.com/api/v0/organizations'
-        self.urldict[qkey] = '/organizations'
-        results = self.build_url()
+        results = self.plan_url(qkey, '/organizations', Organization)
         return results
 
     def get_orgnetworks(self, qkey='orgnetworks'):
         #List the networks in an organization
         #'https://dashboard.meraki.com/api/v0/organizations/[organizationId]/networks'
-        self.urldict[qkey] = '/organizations/'+ self.organization +'/networks'
-        results = self.build_url()
+        results = self.plan_url(qkey, '/organizations/'+ self.organization +'/networks', Network)
         return results
 
     def get_orginventory (self, qkey='inventory'):
         #Return the inventory for an organization
         #'https://dashboard.meraki.com/api/v0/organizations/[id]/inventory'
-        self.urldict[qkey] = '/organizations/'+ self.organization +'/inventory'
-        results = self.build_url()
+        results = self.plan_url(qkey, '/organizations/'+ self.organization +'/inventory', Device)
         return results
 
 
@@ -350,12 +1368,294 @@ class DashApi:
 
     REQUESTS = '''
     '''
+    def plan_url (self, qkey, path, record=None):
+        #register a result key / URL path pair, build_url() issues the plan.
+        #'query' keys are needed right away, so they are fetched immediately.
+        #RECORD names the type a lookup collection's entries are kept as,
+        #their body is then streamed and projected to its fields.
+        if qkey == 'query':
+            return self.fetch(qkey, path, record=record)
+        if self.group is not None:
+            qkey = (self.group, qkey)
+        self.urldict[qkey] = path
+        return self.result
+
     def build_url (self):
-        for k, v in self.urldict.items():
-            self.resource = str(v)
-            self.result_key = str(k)
-            results = self.api_get()
-        return results
+        #issue every planned URL path, each distinct path only once per run.
+        #the transport (_issue) GETs the paths not served otherwise ahead of
+        #fetch(), whatever it leaves is fetched here in sorted key order.
+        paths, keys = self._planned()
+        pending = self._pending(paths)
+        self._issue(pending, lambda path, outcome: self._deliver(keys, path, outcome))
+        for path in paths:
+            self._deliver(keys, path)
+        return self.result
+
+    def _planned (self):
+        #take the planned urldict, returns its distinct paths in sorted key
+        #order and the result keys planned for each path
+        paths = []
+        keys = {}
+        for k, v in sorted(self.urldict.items(), key=lambda kv: str(kv[0])):
+            if str(v) not in keys:
+                paths.append(str(v))
+            keys.setdefault(str(v), []).append(k)
+        self.urldict = {}
+        return paths, keys
+
+    def _pending (self, paths):
+        #PATHS that need a GET: not answered, streamed, unchanged, journaled
+        #or cached
+        return [p for p in paths if p not in self.responses and p not in self.streamed
+            and p not in self.unchanged and (self.journal is None or self.journal.get(p) is None)
+            and self._cache_get(p) is None]
+
+    def _deliver (self, keys, path, outcome=None):
+        #hand the OUTCOME of PATH to the first result key planned for it,
+        #the others are then served from that response by fetch()
+        for k in keys.pop(path, []):
+            self.fetch(k, path, outcome)
+            outcome = None
+
+    def _issue (self, pending, deliver):
+        #transport: with max_concurrency > 1 the PENDING GETs are fanned out
+        #over a bounded thread pool and DELIVER(path, outcome) is called as
+        #each completes, in order, so at most a few in-flight payloads are
+        #held before they are stored or streamed.
+        workers = min(self.params.get('max_concurrency') or 1, len(pending))
+        if workers < 2:
+            return
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            for path, outcome in zip(pending, pool.imap(self._prefetch, pending)):
+                deliver(path, outcome)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    def fetch (self, qkey, path, outcome=None, record=None):
+        #serve repeated paths from earlier responses instead of a new GET
+        self.resource = str(path)
+        self.result_key = qkey
+        if self.resource in self.streamed and self.result_key != 'query':
+            self.result['ansible_facts']['api-requests']['deduplicated'] += 1
+            self._store(self.result_key, self.streamed[self.resource])
+            return self.result
+        if self.resource in self.unchanged and self.result_key != 'query':
+            self.result['ansible_facts']['api-requests']['deduplicated'] += 1
+            return self.result
+        if self.resource in self.responses:
+            self.result['ansible_facts']['api-requests']['deduplicated'] += 1
+        elif self._journal_get(self.resource) is not None:
+            self.result['ansible_facts']['api-requests']['resumed'] += 1
+            self.responses[self.resource] = self._journal_get(self.resource)
+        elif self._cache_get(self.resource) is not None:
+            self.result['ansible_facts']['api-requests']['cached'] += 1
+            self.responses[self.resource] = self.cache_hits.pop(self.resource)
+            if record is not None:
+                self.responses[self.resource] = [record(i) for i in self.responses[self.resource]]
+        else:
+            return self.api_get(outcome, record)
+        if self.result_key == 'query':
+            return self.responses[self.resource]
+        if isinstance(self.responses[self.resource], Pages):
+            self.responses[self.resource] = self.responses[self.resource].complete()
+        self._emit(self.result_key, self.responses[self.resource])
+        return self.result
+
+    def _emit (self, key, payload, etag=None):
+        #store a fetched payload under KEY. With an output sink the payload is
+        #written to the NDJSON file instead, stdout and the dedup table then
+        #only keep its manifest entry (record count and bytes).
+        #In delta mode payloads unchanged since the last run are left out.
+        #For the clients_output rollup, which finish() computes per network,
+        #client lists also go into a ClientTable per device. Tables never go
+        #into stdout: with 'rollup' only the table is kept, so the decoded
+        #client dicts can be freed, 'both' keeps the list as well.
+        rows = payload.to_list() if isinstance(payload, ClientTable) else payload
+        if self.delta is not None:
+            if not self.delta.changed(self.resource, rows, etag):
+                self.unchanged.add(self.resource)
+                return self._drop(key)
+            self.result['ansible_facts']['changed_resources'].append(key)
+        if self.snapshot is not None:
+            self.snapshot.write(self.resource, payload,
+                key[0] if isinstance(key, tuple) else self.networkId)
+        if resource_class(self.resource) == 'clients' and isinstance(payload, (list, ClientTable)) \
+                and self.params.get('clients_output') != 'raw':
+            table = payload if isinstance(payload, ClientTable) else ClientTable(payload)
+            group, name = key if isinstance(key, tuple) else (None, key)
+            self.client_tables.setdefault(group, {})[name.split('-', 1)[-1]] = table
+            if self.params.get('clients_output') == 'rollup':
+                self.responses[self.resource] = table
+                return self._drop(key)
+        if self.sink is None:
+            return self._store(key, rows)
+        self.streamed[self.resource] = self.sink.write(key, rows)
+        self.responses.pop(self.resource, None)
+        self._store(key, self.streamed[self.resource])
+
+    def finish (self, perf=True):
+        #finish the NDJSON file, returning its manifest under 'output', and
+        #persist the delta state for the next run. client_rollup facts are
+        #computed from the client tables. Sweep members leave PERF to
+        #the sweeping DashApi, whose request stats they share.
+        for group, tables in self.client_tables.items():
+            rollup = client_rollup(tables, self.params.get('top_talkers'))
+            self._store('client_rollup' if group is None else (group, 'client_rollup'), rollup)
+        self.client_tables = {}
+        if self.sink is not None:
+            self.result['ansible_facts']['output'] = self.sink.close()
+            self.sink = None
+        if self.delta is not None:
+            self.delta.save()
+        if self.cache is not None:
+            self.cache.close()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.snapshot is not None:
+            #lookup collections keep the records read so far, which are
+            #stored with the fields they were projected to
+            for path, payload in list(self.responses.items()):
+                if resource_class(path) in ('organizations', 'networks', 'inventory') \
+                        and path.startswith('/organizations'):
+                    if isinstance(payload, Pages):
+                        payload = payload.records
+                    self.snapshot.write(path, payload)
+            if self.params.get('snapshot'):
+                self.result['ansible_facts']['snapshot'] = self.snapshot.close()
+            self.snapshot = None
+        if perf:
+            self.result['ansible_facts']['perf'] = self.stats.summary()
+        return self.result
+
+    def release (self):
+        #close what a run leaves open, also when it failed: the NDJSON file
+        #is finished up to its last record, an uncommitted snapshot is
+        #discarded and a journal is kept for a rerun with resume set
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+        if self.snapshot is not None:
+            self.snapshot.discard()
+            self.snapshot = None
+        self._interrupted()
+        self.session.close()
+
+    def sweep_organizations (self, gather, where=None, workers=1):
+        #collect GATHER(api, module) for every organization the API key can
+        #see and WHERE accepts, WORKERS organizations at a time. Every
+        #organization gets its own DashApi: its own session, shard and rate
+        #limit bucket, as the dashboard budgets requests per organization.
+        #stdout is keyed by organization id, 'organization_summary' tells
+        #per organization what was collected or why it failed.
+        organizations = list(self.stream('/organizations', ['id', 'name'], where))
+        self.result['ansible_facts']['organization_summary'] = {}
+        if not organizations:
+            return self.result
+        def sweep(org):
+            params = dict(self.params, organization=str(org['id']), trace_file=None, snapshot=None)
+            api = self.__class__(SweepModule(self.module, params))
+            api.stats = self.stats
+            api.snapshot = self.snapshot
+            if api.baseurl == "https://" + self.params.get('dashboard') + "/api/v0":
+                #no shard pinned for this organization, start where this run does
+                api.baseurl = self.baseurl
+            started = time.time()
+            failure = None
+            try:
+                gather(api, api.module)
+            except SweepFailure as e:
+                failure = api.error or str(e)
+                api._interrupted()
+            finally:
+                api.finish(perf=False)
+                api.release()
+            return api, failure, time.time() - started
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(organizations)))
+        try:
+            for org, outcome in zip(organizations, pool.imap(sweep, organizations)):
+                self._merge_organization(org, *outcome)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        return self.result
+
+    def _merge_organization (self, org, api, failure, seconds):
+        #fold the result of one swept organization into this run's result
+        facts = self.result['ansible_facts']
+        theirs = api.result['ansible_facts']
+        orgid = str(org['id'])
+        if self.snapshot is not None:
+            self.snapshot.write('/organizations', [org])
+        facts['stdout'][orgid] = theirs['stdout']
+        facts['api-endpoints'].update(theirs['api-endpoints'])
+        for k, v in theirs['api-requests'].items():
+            facts['api-requests'][k] += v
+        if 'changed_resources' in facts:
+            facts['changed_resources'].extend([orgid] + list(key) if isinstance(key, tuple)
+                else [orgid, key] for key in theirs.get('changed_resources', []))
+        summary = {'name': org['name'], 'networks': 0 if failure else len(theirs['stdout']),
+            'requests': theirs['api-requests']['issued'], 'seconds': round(seconds, 3),
+            'failed': failure}
+        if 'output' in theirs:
+            summary['output'] = theirs['output']
+        facts['organization_summary'][orgid] = summary
+
+    def _store (self, key, payload):
+        #write PAYLOAD under result KEY in stdout. (networkId, key) tuples,
+        #planned while self.group is set, are nested under their network.
+        stdout = self.result['ansible_facts']['stdout']
+        if isinstance(key, tuple):
+            stdout = stdout.setdefault(key[0], {})
+            key = key[1]
+        stdout[key] = payload
+
+    def _drop (self, key):
+        #remove result KEY from stdout, and its network when left empty
+        stdout = self.result['ansible_facts']['stdout']
+        if isinstance(key, tuple):
+            network = stdout.get(key[0], {})
+            network.pop(key[1], None)
+            if not network:
+                stdout.pop(key[0], None)
+        else:
+            stdout.pop(key, None)
+
+    def _journal_get (self, path):
+        #payload of PATH journaled by an earlier, failed run, for result keys
+        if self.journal is None or self.result_key == 'query':
+            return None
+        return self.journal.get(path)
+
+    def _interrupted (self):
+        #keep the journal of a failing run for the next one with resume set
+        if self.journal is not None:
+            self.journal.close(completed=False)
+            self.result['ansible_facts']['journal'] = self.journal.file
+            self.journal = None
+
+    def _cache_get (self, path):
+        #payload of PATH from the on-disk cache when the cache option is 'use'
+        if self.cache is None or self.params.get('cache') != 'use':
+            return None
+        if path not in self.cache_hits:
+            payload = self.cache.get(self._url(path), resource_class(path))
+            if payload is None:
+                return None
+            self.cache_hits[path] = payload
+        return self.cache_hits[path]
 
     def dep_build_url (self, urldict=None):
         if urldict is None:
@@ -371,8 +1671,10 @@ class DashApi:
         #the ansible module will return failure.
         f= int()
         l = len(self.result['ansible_facts']['api-endpoints'])
-        for k,v in self.result['ansible_facts']['api-endpoints'].iteritems():
-            if v != 200:
+        if not l:
+            return
+        for k,v in self.result['ansible_facts']['api-endpoints'].items():
+            if v not in (200, 304):
                 f += 1
         d = f/float(l)
         threshold = float(thresholdv)
@@ -381,32 +1683,387 @@ class DashApi:
             self.module.fail_json(msg=self.result)
         return
 
-    def api_get(self):
-        url = self.baseurl + self.resource
-        self.result['ansible_facts']['stdout'][self.result_key]={}
-        try:
-            response = requests.request("GET", url, headers=self.headers, verify=False, timeout=20.001) #need a to define acceptable timeout
+    def _conditional(self, resource):
+        #If-None-Match headers for a planned RESOURCE in delta mode. Paged
+        #collections get none: an ETag only covers their first page, whether
+        #they changed is told by the hash of the whole collection instead.
+        if self.delta is None or self._paged_resource(resource):
+            return None
+        return self.delta.headers(resource)
+
+    def _request(self, url, headers=None, stream=False):
+        #issue a single GET. Does not touch self.resource or self.result_key,
+        #so it is safe to call from the build_url() thread pool.
+        #429 and 5xx answers are retried up to max_retries times, every
+        #attempt first takes a token from the shared rate limit bucket.
+        #With STREAM the body is left on the socket for iter_json().
+        attempt = 0
+        redirects = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            cls = self._class(url)
+            started = time.time()
+            try:
+                response = self.session.get(url, headers=headers, timeout=self._timeout(cls),
+                    allow_redirects=False, stream=stream)
+            except requests.RequestException as e:
+                elapsed = time.time() - started
+                self.stats.record(cls, url, type(e).__name__, 0, elapsed, elapsed, started)
+                raise
+            #requests reports the time to response headers (connect, TLS and
+            #server time included) as elapsed, the remainder is the body.
+            #A streamed body returned to the caller is not read yet, _close()
+            #records it with the bytes actually read off the socket.
+            ttfb = response.elapsed.total_seconds()
+            if stream and response.ok and not response.is_redirect:
+                response.pending_stats = (cls, url, ttfb, started)
+            else:
+                if stream:
+                    response.close()
+                size = response.raw.tell() if stream else len(response.content)
+                self.stats.record(cls, url, response.status_code, size, ttfb,
+                    time.time() - started, started)
+            if response.is_redirect:
+                redirects += 1
+                if redirects > 5:
+                    raise requests.TooManyRedirects('Exceeded 5 redirects.', response=response)
+                url = self._redirect(url, response)
+                continue
+            if (response.status_code == 429 or response.status_code >= 500) \
+                    and attempt < self.params.get('max_retries'):
+                delay = self._retry_delay(response, attempt)
+                if self.bucket is not None:
+                    self.bucket.pause(delay)
+                else:
+                    time.sleep(delay)
+                self._retried(cls)
+                attempt += 1
+                continue
             response.raise_for_status()
-            self.result['ansible_facts']['stdout'][self.result_key] = response.json()
+            return response
+
+    def _close(self, response):
+        #close a streamed RESPONSE once its body was read or given up on,
+        #recording the request with the bytes read off the socket
+        response.close()
+        pending = getattr(response, 'pending_stats', None)
+        if pending is not None:
+            response.pending_stats = None
+            cls, url, ttfb, started = pending
+            self.stats.record(cls, url, response.status_code, response.raw.tell(), ttfb,
+                time.time() - started, started)
+
+    def _redirect(self, url, response):
+        #follow a redirect by hand so the API key session header is always
+        #sent, and pin every later request to the shard host redirected to
+        location = urljoin(url, response.headers['Location'])
+        target = urlsplit(location)
+        if target.netloc != urlsplit(self.baseurl).netloc and '/api/v0' in target.path:
+            with self.lock:
+                self.baseurl = target.scheme + '://' + target.netloc + '/api/v0'
+            if self.shards is not None and self.organization:
+                update_json_file(self.shards, {self.shard_key: target.scheme + '://' + target.netloc})
+        return location
+
+    def _class(self, url):
+        #endpoint class of an absolute dashboard URL
+        return resource_class(urlsplit(url).path.split('/api/v0', 1)[-1])
+
+    def _timeout(self, cls):
+        #seconds to wait for the dashboard, endpoint_timeouts override timeout
+        return self.endpoint_timeouts.get(cls, self.timeout)
+
+    def _retry_delay(self, response, attempt):
+        #seconds to back off: Retry-After when the dashboard sends one,
+        #otherwise exponential backoff, both with random jitter added
+        try:
+            delay = float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            delay = min(30.0, 0.5 * 2 ** attempt)
+        return delay + random.uniform(0, delay / 2)
+
+    def _prefetch(self, resource):
+        #thread pool worker, exceptions are handed back to api_get()
+        try:
+            if self._windowed(resource):
+                return self._fetch_windows(resource, parallel=False), None
+            return self._request(self._url(resource), self._conditional(resource)), None
+        except requests.RequestException as e:
+            return None, e
+
+    def _windowed(self, resource):
+        #True for a clients request whose timespan is longer than client_window
+        if not self.params.get('client_window') or resource_class(resource) != 'clients' \
+                or '?' not in resource:
+            return False
+        query = dict(parse_qsl(resource.split('?', 1)[1]))
+        return float(query.get('timespan') or 0) > self.params.get('client_window')
+
+    def _fetch_windows(self, resource, parallel=True):
+        #GET a long clients timespan as consecutive t0/timespan windows,
+        #merged by MAC. Windows are cut as the request goes, at the window
+        #size left by those already fetched, so a slow or large window
+        #shrinks the next ones of the same request. With PARALLEL up to
+        #max_concurrency windows are cut and fetched at once, otherwise one
+        #at a time: the request already holds a max_concurrency slot.
+        path, query = resource.split('?', 1)
+        end = int(time.time())
+        start = end - int(float(dict(parse_qsl(query))['timespan']))
+        fetch = lambda window: self._fetch_window(path, window[0], window[1])
+        workers = 1
+        if parallel:
+            workers = min(self.params.get('max_concurrency') or 1,
+                -(-(end - start) // self.window))
+        pool = None
+        if workers > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(workers)
+        payloads = []
+        try:
+            while start < end:
+                windows = []
+                while start < end and len(windows) < workers:
+                    span = min(self.window, end - start)
+                    windows.append((start, span))
+                    start += span
+                if pool is not None:
+                    payloads.extend(pool.map(fetch, windows))
+                else:
+                    payloads.extend(fetch(window) for window in windows)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return MergedResponse(merge_clients(payloads))
+
+    def _fetch_window(self, path, t0, span):
+        #clients of one window, all pages. A window that times out is split
+        #in two and the window size shrinks, down to MIN_WINDOW.
+        url = self._url('%s?t0=%d&timespan=%d' % (path, t0, span))
+        started = time.time()
+        size = 0
+        payload = []
+        try:
+            while url is not None:
+                self._count('issued')
+                response = self._request(url)
+                size += len(response.content)
+                payload.extend(response.json())
+                url = response.links.get('next', {}).get('url')
+        except requests.Timeout:
+            if span <= MIN_WINDOW:
+                raise
+            self._adapt(None, 0)
+            half = span // 2
+            return merge_clients([self._fetch_window(path, t0, half),
+                self._fetch_window(path, t0 + half, span - half)])
+        self._adapt(time.time() - started, size)
+        return payload
+
+    def _adapt(self, elapsed, size):
+        #halve the client window when a window was slow (over a quarter of
+        #the clients timeout), large or timed out, double it back up to
+        #client_window when a window was quick and small
+        limit = self._timeout('clients')
+        with self.lock:
+            if elapsed is None or elapsed > limit / 4 or size > WINDOW_BYTES:
+                self.window = max(MIN_WINDOW, self.window // 2)
+            elif elapsed < limit / 16 and size < WINDOW_BYTES / 4:
+                self.window = min(self.params.get('client_window'), self.window * 2)
+
+    def _count(self, key, n=1):
+        #add to an api-requests counter, from any thread
+        with self.lock:
+            self.result['ansible_facts']['api-requests'][key] += n
+
+    def _retried(self, cls):
+        #count a retry of a CLS request in perf and api-requests, from any
+        #thread or the asyncio transport's event loop
+        self.stats.retry(cls)
+        self._count('retried')
+
+    def _paged_resource(self, resource):
+        #True for a collection requested per_page records at a time
+        parts = resource.split('?')[0].strip('/').split('/')
+        return bool(self.params.get('per_page')) and bool(len(parts) % 2) \
+            and resource_class(resource) in PAGINATED
+
+    def _url(self, resource):
+        #absolute URL of RESOURCE, collections that page get the per_page size
+        url = self.baseurl + resource
+        if self._paged_resource(resource):
+            url += ('&' if '?' in url else '?') + 'perPage=' + str(self.params.get('per_page'))
+        return url
+
+    def _failed(self, url, e, query=False):
+        #handle the exception E of a GET for URL, or for any page of its
+        #collection: the endpoint is recorded with the error, an HTTP error
+        #leaves the result key empty. Queries, timeouts and connection
+        #errors fail the module, keeping the journal for a rerun.
+        url = getattr(getattr(e, 'request', None), 'url', None) or url
+        self.result['ansible_facts']['api-endpoints'][url] = str(e)
+        if isinstance(e, requests.HTTPError) and not query:
+            return self.result
+        self.error = '%s: %s' % (url, str(e))
+        self.result['ansible_facts']['attempted url'] = url
+        self._interrupted()
+        if query:
+            self.module.fail_json(msg='API query failed! %s' % str(e), **self.result)
+        self._store(self.result_key, str(e))
+        self.module.fail_json(msg=self.result['ansible_facts']['stdout'], **self.result)
+
+    def _page(self, url, record=None, lookup=False):
+        #fetch one follow-up page, returns its records and the next page URL.
+        #Lookup pages (LOOKUP or RECORD set) are read after api_get() returned
+        #and handle their errors here, api_get() handles those of other
+        #collections.
+        self._count('issued')
+        try:
+            response = self._request(url, stream=record is not None)
+        except requests.RequestException as e:
+            if record is None and not lookup:
+                raise
+            self._failed(url, e, query=True)
+        if record is not None:
+            return self._records(response, record), response.links.get('next', {}).get('url')
+        return response.json(), response.links.get('next', {}).get('url')
+
+    def _records(self, response, project):
+        #decode a streamed RESPONSE item by item, yielding what PROJECT makes
+        #of each item; items it turns into None are skipped. A body that
+        #breaks off or does not parse fails the module.
+        try:
+            for item in iter_json(response):
+                item = project(item)
+                if item is not None:
+                    yield item
+        except STREAM_ERRORS as e:
+            self.module.fail_json(msg='API query failed! %s' % str(e))
+        finally:
+            self._close(response)
+
+    def stream (self, path, fields=None, where=None):
+        #records of the collection at PATH, decoded one at a time straight
+        #from the socket and reduced to FIELDS (every field when None).
+        #WHERE, when given, is called with each full record and drops those
+        #it returns False for. Pages are requested as iteration reaches them
+        #and nothing is kept, so a caller that stops early reads no further.
+        def project(item):
+            if where is not None and not where(item):
+                return None
+            if fields is None:
+                return item
+            return dict((f, item.get(f)) for f in fields)
+        url = self._url(path)
+        while url is not None:
+            self.result['ansible_facts']['api-requests']['issued'] += 1
+            try:
+                response = self._request(url, stream=True)
+            except requests.RequestException as e:
+                self.module.fail_json(msg='API query failed! %s' % str(e))
+            url = response.links.get('next', {}).get('url')
+            for item in self._records(response, project):
+                yield item
+
+    def _paged(self, url, response, record=None):
+        #first page payload, or Pages over it when the dashboard links a next
+        #page. Only complete collections are written to the response cache.
+        #Lookup collections (RECORD set) are always Pages over the streamed
+        #body, kept as RECORD objects and cached as their projected dicts.
+        if record is not None:
+            on_complete = None
+            if self.cache is not None:
+                on_complete = lambda records: self.cache.put(url, [r.to_dict() for r in records])
+            return Pages(self._records(response, record), response.links.get('next', {}).get('url'),
+                lambda nexturl: self._page(nexturl, record), on_complete, url)
+        payload = response.json()
+        nexturl = response.links.get('next', {}).get('url')
+        if nexturl is None:
+            if self.cache is not None:
+                self.cache.put(url, payload)
+            return payload
+        on_complete = None
+        if self.cache is not None:
+            on_complete = lambda records: self.cache.put(url, records)
+        if self.result_key == 'query':
+            return Pages(payload, nexturl, lambda nexturl: self._page(nexturl, lookup=True),
+                on_complete)
+        return Pages(payload, nexturl, self._page, on_complete).complete()
+
+    def _spooling (self):
+        #True when the payload of the current result key only goes to the
+        #NDJSON file, nothing else (delta, journal, cache, snapshot, client
+        #rollup) needs it whole, so it is written page by page as decoded
+        return self.sink is not None and self.result_key != 'query' and self.delta is None \
+            and self.journal is None and self.cache is None and self.snapshot is None \
+            and (resource_class(self.resource) != 'clients'
+                or self.params.get('clients_output') == 'raw')
+
+    def _spool (self, key, response, buffered=False):
+        #write the records of RESPONSE and of every page after it to the
+        #NDJSON file as they are decoded, returns the manifest entry of KEY.
+        #BUFFERED responses were read in full by the request pool already.
+        if isinstance(response, MergedResponse):
+            return self.sink.write(key, response.json())
+        manifest = {'records': 0, 'bytes': 0}
+        while True:
+            nexturl = response.links.get('next', {}).get('url')
+            try:
+                entry = self.sink.write_records(key, iter_json(response, buffered))
+            except STREAM_ERRORS as e:
+                raise requests.ConnectionError(str(e))
+            finally:
+                if not buffered:
+                    self._close(response)
+            manifest['records'] += entry['records']
+            manifest['bytes'] += entry['bytes']
+            if nexturl is None:
+                return manifest
+            self._count('issued')
+            response = self._request(nexturl, stream=True)
+            buffered = False
+
+    def api_get(self, outcome=None, record=None):
+        url = self._url(self.resource)
+        self._store(self.result_key, {})
+        if not self._windowed(self.resource):
+            self._count('issued')
+        try:
+            if outcome is None and self.result_key == 'query':
+                response = self._request(url, stream=record is not None)
+            elif outcome is None and self._windowed(self.resource):
+                response = self._fetch_windows(self.resource)
+            elif outcome is None:
+                response = self._request(url, self._conditional(self.resource),
+                    stream=self._spooling())
+            else:
+                response, error = outcome
+                if error is not None:
+                    raise error
             self.result['ansible_facts']['api-endpoints'][url]=response.status_code
-        except requests.Timeout as e:
-            self.result['ansible_facts']['stdout'][self.result_key] = response.status_code
-            self.result['ansible_facts']['attempted url'] = url
-            self.module.fail_json(msg=self.result['ansible_facts']['stdout'], **self.result)
-        except requests.HTTPError as e:
+            if response.status_code == 304:
+                self.unchanged.add(self.resource)
+                self._drop(self.result_key)
+                return self.result
+            if self._spooling():
+                self.streamed[self.resource] = self._spool(self.result_key, response, outcome is not None)
+                self._store(self.result_key, self.streamed[self.resource])
+                return self.result
+            if self.result_key != 'query':
+                record = None
+            self.responses[self.resource] = self._paged(url, response, record)
+            if self.journal is not None and self.result_key != 'query':
+                self.journal.write(self.resource, self.responses[self.resource])
             if self.result_key == 'query':
-                self.module.fail_json(msg='API query failed! %s' % str(e))
+                self._store(self.result_key, self.responses[self.resource])
             else:
-                self.result['ansible_facts']['api-endpoints'][url]=str(e)
-            return self.result
-        except requests.ConnectionError as e:
-            self.result['ansible_facts']['stdout'][self.result_key] = str(e)
-            self.result['ansible_facts']['attempted url'] = url
-            self.module.fail_json(msg=self.result['ansible_facts']['stdout'], **self.result)
+                etag = None if self._paged_resource(self.resource) else response.headers.get('ETag')
+                self._emit(self.result_key, self.responses[self.resource], etag)
+        except requests.RequestException as e:
+            return self._failed(url, e, self.result_key == 'query')
         if self.params.get('headers'):
             self.result['ansible_facts']['headers'] = response.headers
         if self.result_key == 'query':
-            results = self.result['ansible_facts']['stdout'][self.result_key]
-            del self.result['ansible_facts']['stdout'][self.result_key]
-            return results
+            return self.result['ansible_facts']['stdout'].pop(self.result_key)
         return self.result
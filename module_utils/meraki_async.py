@@ -0,0 +1,237 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import parse_header_links
+
+from ansible.module_utils.meraki import DashApi, MergedResponse
+
+#asyncio transport for DashApi, selected with transport=async. Needs
+#Python 3.5+ and aiohttp, meraki.dash_api() only imports it when selected.
+
+
+def running_loop():
+    #the loop the calling coroutine runs on, get_running_loop() is 3.7+
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        return asyncio.get_event_loop()
+
+
+class RequestContext(object):
+    #state of one in-flight GET: what the sync transport keeps on the
+    #DashApi instance (resource, url, retry and redirect counts) travels
+    #with the request instead, so any number of them can be awaited at once
+    __slots__ = ('path', 'url', 'headers', 'attempt', 'redirects')
+
+    def __init__(self, path, url, headers=None):
+        self.path = path
+        self.url = url
+        self.headers = headers
+        self.attempt = 0
+        self.redirects = 0
+
+
+class Response(object):
+    #the parts of a requests.Response that DashApi reads, filled from an
+    #aiohttp answer whose body has been read
+    def __init__(self, url, status, reason, headers, content):
+        self.url = url
+        self.status_code = status
+        self.reason = reason
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+
+    @property
+    def is_redirect(self):
+        return 'location' in self.headers and self.status_code in (301, 302, 303, 307, 308)
+
+    @property
+    def links(self):
+        links = {}
+        for link in parse_header_links(self.headers.get('link', '')):
+            links[link.get('rel') or link.get('url')] = link
+        return links
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('%s Error: %s for url: %s' % (self.status_code,
+                self.reason, self.url), response=self, request=requests.Request('GET', self.url))
+
+
+class AsyncDashApi(DashApi):
+    #DashApi whose planned requests are issued on an asyncio event loop:
+    #up to max_concurrency GETs in flight over at most pool_size aiohttp
+    #connections, rate limited, retried and redirected like the sync
+    #transport. build_url() stays synchronous, so gather_keys() is
+    #unchanged; lookups ('query' keys) still use the requests session.
+    def __init__(self, module):
+        DashApi.__init__(self, module)
+        self.asession = None
+
+    def _issue(self, pending, deliver):
+        #sync facade: run the requests to completion on a private event loop
+        if not pending:
+            return
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._issue_all(pending, deliver))
+        finally:
+            loop.close()
+
+    async def _issue_all(self, pending, deliver):
+        try:
+            await self.issue(pending, deliver)
+        finally:
+            await self.close()
+
+    async def issue(self, pending, deliver):
+        #GET every PENDING path concurrently, calling DELIVER(path, outcome)
+        #as each completes. DELIVER writes the cache, NDJSON file, journal
+        #and snapshot, so it runs on a single delivery thread: one at a time,
+        #result state is never touched by two requests at once, and the loop
+        #keeps serving the requests in flight meanwhile.
+        limit = asyncio.Semaphore(max(1, self.params.get('max_concurrency') or 1))
+        session = self._session()
+        loop = running_loop()
+        delivery = ThreadPoolExecutor(1)
+
+        async def issue_one(path):
+            context = RequestContext(path, self._url(path), self._conditional(path))
+            async with limit:
+                if self._windowed(path):
+                    #client timespan windows are fetched and merged by the
+                    #sync transport, on an executor thread
+                    outcome = await loop.run_in_executor(None, self._prefetch, path)
+                else:
+                    outcome = await self._prefetch_async(session, context)
+            await loop.run_in_executor(delivery, deliver, path, outcome)
+
+        tasks = [asyncio.ensure_future(issue_one(path)) for path in pending]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            delivery.shutdown()
+
+    async def get(self, getter, *args, **kwargs):
+        #awaitable form of the get_* planners, e.g.
+        #  await api.get(api.get_uplink, serial=serial, model=model)
+        #plans what GETTER plans, issues it right away and returns the
+        #payloads by result key (None when nothing was planned)
+        planned, self.urldict = self.urldict, {}
+        try:
+            getter(*args, **kwargs)
+            paths, keys = self._planned()
+        finally:
+            self.urldict = planned
+        batch = [k for path in paths for k in keys[path]]
+        await self.issue(self._pending(paths), lambda path, outcome: self._deliver(keys, path, outcome))
+        for path in paths:
+            self._deliver(keys, path)
+        stdout = self.result['ansible_facts']['stdout']
+        payloads = {}
+        for key in batch:
+            if isinstance(key, tuple):
+                payloads[key] = stdout.get(key[0], {}).get(key[1])
+            else:
+                payloads[key] = stdout.get(key)
+        return payloads or None
+
+    async def close(self):
+        if self.asession is not None:
+            await self.asession.close()
+            self.asession = None
+
+    def _session(self):
+        #one aiohttp session per event loop, its connector caps connections
+        #at pool_size however many requests are in flight
+        if self.asession is None:
+            connector = aiohttp.TCPConnector(limit=self.params.get('pool_size'), ssl=False,
+                force_close=not self.params.get('keepalive'))
+            self.asession = aiohttp.ClientSession(connector=connector, headers=self.headers)
+        return self.asession
+
+    async def _prefetch_async(self, session, context):
+        #outcome tuple like _prefetch(), errors mapped to requests exceptions
+        #of the URL that failed so api_get() handles both transports alike
+        try:
+            response = await self._request_async(session, context)
+            return await self._pages_async(session, context, response), None
+        except asyncio.TimeoutError as e:
+            return None, requests.Timeout('timed out: %s %s' % (context.url, str(e)),
+                request=requests.Request('GET', context.url))
+        except aiohttp.ClientError as e:
+            return None, requests.ConnectionError('%s: %s' % (context.url, str(e)),
+                request=requests.Request('GET', context.url))
+        except requests.RequestException as e:
+            return None, e
+
+    async def _pages_async(self, session, context, response):
+        #the pages after RESPONSE of a paged collection are fetched here, on
+        #the loop, so delivery does not GET them over the requests session.
+        #Returns RESPONSE, or a MergedResponse of every page.
+        nexturl = response.links.get('next', {}).get('url')
+        if nexturl is None:
+            return response
+        payload = response.json()
+        while nexturl is not None:
+            self._count('issued')
+            context.url, context.headers, context.attempt, context.redirects = nexturl, None, 0, 0
+            page = await self._request_async(session, context)
+            payload.extend(page.json())
+            nexturl = page.links.get('next', {}).get('url')
+        merged = MergedResponse(payload)
+        merged.headers = response.headers
+        return merged
+
+    async def _request_async(self, session, context):
+        #one GET with the rate limit, retry and redirect handling of _request()
+        while True:
+            if self.bucket is not None:
+                wait = self.bucket.take()
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = self.bucket.take()
+            cls = self._class(context.url)
+            started = time.time()
+            try:
+                async with session.get(context.url, headers=context.headers, allow_redirects=False,
+                        timeout=aiohttp.ClientTimeout(total=self._timeout(cls))) as answer:
+                    ttfb = time.time() - started
+                    content = await answer.read()
+                    response = Response(context.url, answer.status, answer.reason, answer.headers, content)
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                elapsed = time.time() - started
+                self.stats.record(cls, context.url, type(e).__name__, 0, elapsed, elapsed, started)
+                raise
+            self.stats.record(cls, context.url, response.status_code, len(content), ttfb,
+                time.time() - started, started)
+            if response.is_redirect:
+                context.redirects += 1
+                if context.redirects > 5:
+                    raise requests.TooManyRedirects('Exceeded 5 redirects.', response=response)
+                context.url = self._redirect(context.url, response)
+                continue
+            if (response.status_code == 429 or response.status_code >= 500) \
+                    and context.attempt < self.params.get('max_retries'):
+                delay = self._retry_delay(response, context.attempt)
+                if self.bucket is not None:
+                    self.bucket.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+                self._retried(cls)
+                context.attempt += 1
+                continue
+            response.raise_for_status()
+            return response
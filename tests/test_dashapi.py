@@ -0,0 +1,182 @@
+'''
+Regression tests of DashApi and its helpers, requests are served by the
+offline mock dashboard, see bench/mock_dashboard.py.
+
+    python -m unittest discover tests
+
+Requires ansible and requests to be importable, no network access.
+'''
+import importlib.util
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+
+from bench_dashapi import BenchFailure, BenchModule, load_modules, module_params
+from mock_dashboard import Dataset, MockDashboard
+
+
+class Module(BenchModule):
+    #fail_json() serializes its result to JSON like AnsibleModule does
+    def fail_json(self, **kwargs):
+        raise BenchFailure(json.dumps(kwargs))
+
+
+class TimeoutAfterClients(unittest.TestCase):
+    #api_get() timing out once a clients payload is in stdout must fail the
+    #module with a result that can be serialized
+
+    def setUp(self):
+        self.meraki, _ = load_modules()
+        self.dataset = Dataset(1, 1, 2, 5)
+        self.server = MockDashboard(self.dataset, latency=0.2).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail_after_clients(self, clients_output):
+        network = self.dataset.networks['552400'][0]['id']
+        serial = self.dataset.inventory['552400'][0]['serial']
+        module = Module(module_params(self.meraki, {'networkid': network,
+            'clients_output': clients_output, 'rate_limit': 0}))
+        dash = self.meraki.dash_api(module)
+        dash.baseurl = self.server.baseurl
+        dash.fetch('clients-' + serial, '/devices/%s/clients?timespan=86400' % serial)
+        dash.endpoint_timeouts['networks'] = 0.01
+        try:
+            with self.assertRaises(BenchFailure) as failure:
+                dash.fetch('network', '/networks/' + network)
+        finally:
+            dash.release()
+        return json.loads(str(failure.exception)), serial
+
+    def test_raw(self):
+        result, serial = self.fail_after_clients('raw')
+        stdout = result['ansible_facts']['stdout']
+        self.assertEqual(len(stdout['clients-' + serial]), 5)
+        self.assertIn('network', stdout)
+        self.assertTrue(result['ansible_facts']['attempted url'].endswith('/networks/N_00000'))
+
+    def test_both(self):
+        result, serial = self.fail_after_clients('both')
+        self.assertEqual(len(result['ansible_facts']['stdout']['clients-' + serial]), 5)
+
+    def test_rollup(self):
+        result, serial = self.fail_after_clients('rollup')
+        self.assertNotIn('clients-' + serial, result['ansible_facts']['stdout'])
+
+
+class AsyncTransport(unittest.TestCase):
+    #transport=async must import on Python 3 as the module ships, without
+    #stand-ins for Python 2 modules, and collect what the sync one does
+
+    def setUp(self):
+        if importlib.util.find_spec('aiohttp') is None:
+            self.skipTest('aiohttp is not installed')
+        self.meraki, self.facts = load_modules()
+        self.dataset = Dataset(1, 2, 3, 5)
+        self.server = MockDashboard(self.dataset).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def collect(self, transport):
+        module = Module(module_params(self.meraki, {'scope': 'organization',
+            'transport': transport, 'max_concurrency': 4, 'rate_limit': 0}))
+        dash = self.meraki.dash_api(module)
+        dash.baseurl = self.server.baseurl
+        try:
+            result = self.facts.gather_keys(dash, module)
+        finally:
+            dash.release()
+        return dash, result['ansible_facts']['stdout']
+
+    def test_matches_sync(self):
+        dash, stdout = self.collect('async')
+        self.assertEqual(type(dash).__name__, 'AsyncDashApi')
+        self.assertEqual(stdout, self.collect('sync')[1])
+
+
+class MergeClients(unittest.TestCase):
+    #client lists of consecutive windows: usage summed per MAC, in any
+    #case, other fields from the latest window
+
+    def setUp(self):
+        self.meraki, _ = load_modules()
+
+    def test_windows(self):
+        merged = self.meraki.merge_clients([
+            [{'mac': 'AA:BB:CC:00:00:01', 'ip': '10.0.0.1', 'usage': {'sent': 1.0, 'recv': 2.0}},
+             {'mac': 'aa:bb:cc:00:00:02', 'usage': {'sent': 5.0, 'recv': 5.0}}],
+            [{'mac': 'aa:bb:cc:00:00:01', 'ip': '10.0.0.9', 'usage': {'sent': 3.0, 'recv': 4.0}},
+             {'mac': 'aa:bb:cc:00:00:03', 'usage': None}]])
+        self.assertEqual([c['mac'] for c in merged],
+            ['aa:bb:cc:00:00:01', 'aa:bb:cc:00:00:02', 'aa:bb:cc:00:00:03'])
+        self.assertEqual(merged[0]['ip'], '10.0.0.9')
+        self.assertEqual(merged[0]['usage'], {'sent': 4.0, 'recv': 6.0})
+        self.assertEqual(merged[2]['usage'], {'sent': 0.0, 'recv': 0.0})
+
+
+class ClientRollup(unittest.TestCase):
+    #a MAC seen by several devices is counted once, with the largest usage
+
+    def setUp(self):
+        self.meraki, _ = load_modules()
+
+    def rollup(self, top=10):
+        table = self.meraki.ClientTable
+        return self.meraki.client_rollup({
+            'Q-MS': table([
+                {'mac': 'AA:BB:CC:00:00:01', 'vlan': 10, 'usage': {'sent': 1.0, 'recv': 1.0}},
+                {'mac': 'aa:bb:cc:00:00:02', 'vlan': 10, 'usage': {'sent': 3.0, 'recv': 3.0}}]),
+            'Q-MR': table([
+                {'mac': 'aa:bb:cc:00:00:01', 'vlan': 10, 'usage': {'sent': 8.0, 'recv': 2.0}},
+                {'mac': 'aa:bb:cc:00:00:03', 'usage': {'sent': 0.5, 'recv': 0.5}}])}, top)
+
+    def test_mac_case(self):
+        rollup = self.rollup()
+        self.assertEqual(rollup['clients'], 3)
+        self.assertEqual(rollup['sent'], 11.5)
+        self.assertEqual(rollup['recv'], 5.5)
+        self.assertEqual(rollup['devices']['Q-MS'], {'clients': 2, 'sent': 4.0, 'recv': 4.0})
+
+    def test_missing_vlan(self):
+        rollup = self.rollup()
+        self.assertEqual(rollup['vlans']['none'], {'clients': 1, 'sent': 0.5, 'recv': 0.5})
+        self.assertEqual(rollup['vlans']['10'], {'clients': 2, 'sent': 11.0, 'recv': 5.0})
+        self.assertNotIn('vlan', rollup['top_talkers'][-1])
+
+    def test_top_talkers(self):
+        self.assertEqual([t['mac'] for t in self.rollup()['top_talkers']],
+            ['aa:bb:cc:00:00:01', 'aa:bb:cc:00:00:02', 'aa:bb:cc:00:00:03'])
+        talkers = self.rollup(top=2)['top_talkers']
+        self.assertEqual([(t['sent'], t['recv']) for t in talkers], [(8.0, 2.0), (3.0, 3.0)])
+
+
+class TokenBucketPause(unittest.TestCase):
+    #429s answered together pause the bucket until the latest Retry-After,
+    #their pauses overlap instead of adding up
+
+    def setUp(self):
+        self.meraki, _ = load_modules()
+
+    def test_overlapping_pauses(self):
+        bucket = self.meraki.TokenBucket(5)
+        for _ in range(8):
+            bucket.pause(1.0)
+        self.assertAlmostEqual(bucket.take(), 1.2, delta=0.05)
+
+    def test_longer_pause_extends(self):
+        bucket = self.meraki.TokenBucket(5)
+        bucket.pause(1.0)
+        bucket.pause(3.0)
+        bucket.pause(2.0)
+        self.assertAlmostEqual(bucket.take(), 3.2, delta=0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()